@@ -0,0 +1,167 @@
+# embedding_dimensions.py
+# benchmark for the reduced-dimension embedding mode of the cosine method
+# for each width it measures how well the token ranking agrees with the full width ranking
+# against how many bytes come back from the api and how long the scoring takes
+#
+# run from the project folder (uses OPENAI_API_KEY or the key saved in .api_config.json):
+#   python -m benchmarks.embedding_dimensions --prompts 10 > bench_output.txt
+#
+# https://platform.openai.com/docs/guides/embeddings#use-cases (reducing embedding dimensions)
+# https://en.wikipedia.org/wiki/Spearman%27s_rank_correlation_coefficient
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from features.methods.cosine_similarity.scoring import cosine_importance
+from utils.data_handler import load_custom_dataset
+from utils.embeddings import chunk_inputs, count_tokens, decode_embedding
+
+SKIP_TOKENS = ["", " ", ".", ",", "!", "?"]  # same skip list as the cosine frame
+
+
+def load_api_key():
+    api_key = os.environ.get("OPENAI_API_KEY", "")
+    config_file = os.path.join(os.getcwd(), ".api_config.json")
+    if not api_key and os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            api_key = json.load(f).get("api_key", "")
+    return api_key
+
+
+def leave_one_out_texts(prompt, enc, max_tokens):
+    tokens_ids = enc.encode(prompt)[:max_tokens]
+    texts = []
+    for i, token_id in enumerate(tokens_ids):
+        token = enc.decode_single_token_bytes(token_id).decode("utf-8", errors="ignore")
+        if token.strip() in SKIP_TOKENS:
+            continue
+        perturbed_text = enc.decode(tokens_ids[:i] + tokens_ids[i + 1 :])
+        if perturbed_text:
+            texts.append(perturbed_text)
+    return texts
+
+
+def fetch_embeddings(client, texts, model, dimensions):
+    # uncached on purpose so the payload size and request time are real
+    embeddings = [None] * len(texts)
+    payload_bytes = 0
+    request_seconds = 0.0
+
+    options = {"encoding_format": "base64"}
+    if dimensions:
+        options["dimensions"] = dimensions
+
+    for chunk in chunk_inputs(count_tokens(texts)):
+        start = time.perf_counter()
+        response = client.embeddings.create(
+            input=[texts[i] for i in chunk], model=model, **options
+        )
+        request_seconds += time.perf_counter() - start
+
+        for item in response.data:
+            payload_bytes += len(item.embedding)
+            embeddings[chunk[item.index]] = decode_embedding(item.embedding)
+
+    return np.vstack(embeddings), payload_bytes, request_seconds
+
+
+def spearman(a, b):
+    rank_a = np.argsort(np.argsort(a)).astype(np.float64)
+    rank_b = np.argsort(np.argsort(b)).astype(np.float64)
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return 1.0
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+def top_k_overlap(a, b, k):
+    k = min(k, len(a))
+    if k == 0:
+        return 1.0
+    return len(set(np.argsort(-a)[:k]) & set(np.argsort(-b)[:k])) / k
+
+
+def time_scoring(original, perturbed, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        cosine_importance(original, perturbed)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding dimensions benchmark")
+    parser.add_argument("--prompts", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[256, 512, 1536])
+    parser.add_argument("--model", default="text-embedding-3-small")
+    parser.add_argument("--max-tokens", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    import tiktoken
+    from openai import OpenAI
+
+    api_key = load_api_key()
+    if not api_key:
+        raise SystemExit("No API key found, set OPENAI_API_KEY or save one in the app.")
+
+    client = OpenAI(api_key=api_key)
+    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    prompts = load_custom_dataset()[: args.prompts]
+    full_width = max(args.dimensions)
+
+    totals = {
+        d: {"spearman": [], "overlap": [], "bytes": 0, "request": 0.0, "scoring": 0.0}
+        for d in args.dimensions
+    }
+
+    for prompt in prompts:
+        texts = [prompt] + leave_one_out_texts(prompt, enc, args.max_tokens)
+        if len(texts) < 3:
+            continue
+
+        scores = {}
+        for dimensions in args.dimensions:
+            matrix, payload_bytes, request_seconds = fetch_embeddings(
+                client, texts, args.model, dimensions
+            )
+            scores[dimensions] = cosine_importance(matrix[0], matrix[1:])
+            totals[dimensions]["bytes"] += payload_bytes
+            totals[dimensions]["request"] += request_seconds
+            totals[dimensions]["scoring"] += time_scoring(
+                matrix[0], matrix[1:], args.repeats
+            )
+
+        for dimensions in args.dimensions:
+            totals[dimensions]["spearman"].append(
+                spearman(scores[dimensions], scores[full_width])
+            )
+            totals[dimensions]["overlap"].append(
+                top_k_overlap(scores[dimensions], scores[full_width], args.top_k)
+            )
+
+    print(f"Embedding dimensions benchmark - {args.model}, {len(prompts)} prompts")
+    print(f"Agreement is measured against the {full_width} dimension ranking\n")
+    print(
+        f"{'DIMS':<8}{'SPEARMAN':<12}{f'TOP-{args.top_k}':<10}{'PAYLOAD KB':<14}{'REQUEST S':<12}{'SCORING MS':<12}"
+    )
+    print("-" * 68)
+    for dimensions in args.dimensions:
+        row = totals[dimensions]
+        if not row["spearman"]:
+            continue
+        print(
+            f"{dimensions:<8}"
+            f"{np.mean(row['spearman']):<12.3f}"
+            f"{np.mean(row['overlap']):<10.2f}"
+            f"{row['bytes'] / 1024:<14.1f}"
+            f"{row['request']:<12.2f}"
+            f"{row['scoring'] * 1000:<12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 # display tokens report generator
+# https://github.com/openai/tiktoken/blob/main/tiktoken/core.py (encode_ordinary_batch, decode_tokens_bytes)
 import datetime
 from tkinter import filedialog
 
+ENCODE_CHUNK_SIZE = 1000  # prompts encoded per batch, keeps memory flat on big datasets
+ENCODE_THREADS = 8
+WRITE_BUFFER_BYTES = 1024 * 1024
+
 
 def generate_token_report(prompts, tokenizer, filename=None):
     if filename is None:
@@ -19,45 +24,53 @@ def generate_token_report(prompts, tokenizer, filename=None):
         if not filename:
             return None
 
-    with open(filename, "w", encoding="utf-8") as f:
+    total_tokens = 0
+    with open(filename, "w", encoding="utf-8", buffering=WRITE_BUFFER_BYTES) as f:
         f.write(
             f"Token Report - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
         )
         f.write(f"Tokenizer: cl100k_base (used by GPT-4 and ChatGPT)\n\n")
 
-        for i, prompt in enumerate(prompts, 1):
-            f.write(f"Prompt {i}:\n")
-            f.write("-" * 80 + "\n")
-            f.write(prompt + "\n")
-            f.write("-" * 80 + "\n")
-
-            token_ids = tokenizer.encode(prompt)  # token info
-            f.write(f"Total tokens: {len(token_ids)}\n\n")
+        # prompts are encoded a chunk at a time on tiktoken's threads, each prompt only once
+        for chunk_start in range(0, len(prompts), ENCODE_CHUNK_SIZE):
+            chunk = prompts[chunk_start:chunk_start + ENCODE_CHUNK_SIZE]
+            chunk_token_ids = tokenizer.encode_ordinary_batch(chunk, num_threads=ENCODE_THREADS)
 
-            f.write("Token breakdown:\n")
-            f.write(f"{'Index':<10}{'Token Text':<50}{'Token ID':<10}\n")
-            f.write("-" * 70 + "\n")
+            for i, (prompt, token_ids) in enumerate(zip(chunk, chunk_token_ids), chunk_start + 1):
+                total_tokens += len(token_ids)
+                lines = [
+                    f"Prompt {i}:\n",
+                    "-" * 80 + "\n",
+                    prompt + "\n",
+                    "-" * 80 + "\n",
+                    f"Total tokens: {len(token_ids)}\n\n",
+                    "Token breakdown:\n",
+                    f"{'Index':<10}{'Token Text':<50}{'Token ID':<10}\n",
+                    "-" * 70 + "\n",
+                ]
 
-            for j, token_id in enumerate(token_ids):
-                token_text = tokenizer.decode([token_id])
+                # all token pieces in one call, same text as decode([token_id])
+                token_bytes = tokenizer.decode_tokens_bytes(token_ids)
+                for j, (token_id, piece) in enumerate(zip(token_ids, token_bytes)):
+                    token_text = piece.decode("utf-8", errors="replace")
 
-                if token_text == "\n":
-                    token_text_display = "\\n"
-                elif token_text == "\t":
-                    token_text_display = "\\t"
-                elif token_text == " ":
-                    token_text_display = "·"
-                elif len(token_text.strip()) == 0 and len(token_text) > 1:
-                    token_text_display = "·" * len(token_text)
-                else:
-                    token_text_display = token_text
+                    if token_text == "\n":
+                        token_text_display = "\\n"
+                    elif token_text == "\t":
+                        token_text_display = "\\t"
+                    elif token_text == " ":
+                        token_text_display = "·"
+                    elif len(token_text.strip()) == 0 and len(token_text) > 1:
+                        token_text_display = "·" * len(token_text)
+                    else:
+                        token_text_display = token_text
 
-                f.write(f"{j:<10}{token_text_display:<50}{token_id:<10}\n")
+                    lines.append(f"{j:<10}{token_text_display:<50}{token_id:<10}\n")
 
-            f.write("\n\n")
+                lines.append("\n\n")
+                f.write("".join(lines))  # one write per prompt, nothing kept after it
 
-        # add summary
-        total_tokens = sum(len(tokenizer.encode(p)) for p in prompts)
+        # add summary, counted while writing
         f.write(f"Summary:\n")
         f.write("-" * 80 + "\n")
         f.write(f"Total prompts: {len(prompts)}\n")
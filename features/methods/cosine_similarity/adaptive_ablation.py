@@ -0,0 +1,69 @@
+# adaptive (coarse-to-fine) ablation for the cosine method
+# whole sentences or word spans are removed first, then only the spans whose removal moves the
+# embedding above the threshold are split and ablated again, so the number of embeddings
+# scales with the number of important regions instead of the prompt length
+
+import numpy as np
+
+from utils.token_spans import child_spans
+
+DEFAULT_THRESHOLD = 0.01  # 1 - cosine similarity a span needs before it gets refined
+
+
+def adaptive_ablation(
+    tokens_ids,
+    tokens,
+    decode,
+    score_texts,
+    threshold=DEFAULT_THRESHOLD,
+    skip_token=None,
+    on_round=None,
+):
+    # score_texts(texts) -> importance per text (1 - cosine similarity to the original)
+    # returns an importance value for every token position, the (start, end) span whose removal
+    # gave it that value (None if it was never scored) plus some run stats
+    # on_round(done, total) after every round, done = positions whose value is final
+    importance = np.zeros(len(tokens_ids), dtype=np.float64)
+    spans = [None] * len(tokens_ids)
+    stats = {"rounds": 0, "spans_scored": 0}
+
+    to_refine = [((0, len(tokens_ids)), 0)]  # (span, level its children are taken from)
+
+    while to_refine:
+        candidates = []  # (span, level of the span)
+        for span, level in to_refine:
+            children, child_level = child_spans(tokens, span, level)
+            for start, end in children:
+                if skip_token and all(skip_token(tokens[i]) for i in range(start, end)):
+                    continue  # whitespace / punctuation only, left at 0
+                candidates.append(((start, end), child_level))
+
+        if not candidates:
+            break
+
+        texts = [
+            decode(tokens_ids[:start] + tokens_ids[end:])
+            for (start, end), _ in candidates
+        ]
+
+        scores = np.ones(len(candidates))  # removing the whole prompt = completely different
+        requested = [n for n, text in enumerate(texts) if text]  # api rejects empty strings
+        if requested:
+            scores[requested] = score_texts([texts[n] for n in requested])
+
+        stats["rounds"] += 1
+        stats["spans_scored"] += len(candidates)
+
+        to_refine = []
+        for ((start, end), level), score in zip(candidates, scores):
+            if score >= threshold and end - start > 1:
+                to_refine.append(((start, end), level + 1))
+            else:
+                importance[start:end] = score / (end - start)  # share the span's effect
+                spans[start:end] = [(start, end)] * (end - start)
+
+        if on_round:
+            pending = sum(end - start for (start, end), _ in to_refine)
+            on_round(len(tokens_ids) - pending, len(tokens_ids))
+
+    return importance, spans, stats
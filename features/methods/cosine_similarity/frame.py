@@ -1,19 +1,36 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import os
 import threading
 import time
 from datetime import datetime
 from frames.feature_frames import BaseFeatureFrame
-from sklearn.metrics.pairwise import cosine_similarity 
+from features.methods.cosine_similarity.adaptive_ablation import adaptive_ablation
+from features.methods.cosine_similarity.scoring import (
+    cosine_importance,
+    min_max_normalize,
+)
+from utils.embedding_backends import LocalNgramEmbeddingBackend, OpenAIEmbeddingBackend
 
 # note idx is index
 
+FULL_EMBEDDING_DIMENSIONS = 1536  # native width of text-embedding-3-small
+EMBEDDING_DIMENSION_OPTIONS = ["1536", "512", "256"]  # smaller = fewer bytes per embedding
+
+LEAVE_ONE_OUT_MODE = "Leave-one-out"  # one embedding per token, first 50 tokens only
+ADAPTIVE_MODE = "Adaptive (coarse-to-fine)"  # sentences -> words -> tokens, no token cap
+
+OPENAI_BACKEND = "OpenAI"  # text-embedding-3-small through the api
+LOCAL_BACKEND = "Local (n-gram TF-IDF)"  # offline, for pre-screening datasets
+
 class CosineSimilarityFrame(BaseFeatureFrame):
     def __init__(self, parent, controller):
         self.api_key = controller.api_key # get data (api key from controller + prompts)
         self.prompts = (
             controller.random_prompts if hasattr(controller, "random_prompts") else []
         )
+        self.local_backend = None  # fitted once on the dataset, see create_embedding_backend
+        self.batch_report = None  # BatchReportWriter while a batch with a report is running
         super().__init__(parent, controller, "Cosine Similarity")
 
     def create_content(self):
@@ -33,6 +50,71 @@ class CosineSimilarityFrame(BaseFeatureFrame):
         self.result_data = {}
         self.prompt_frames = {}
 
+        options_frame = ttk.Frame(content_container)  # analysis settings
+        options_frame.pack(fill=tk.X, pady=10)
+
+        backend_label = ttk.Label(
+            options_frame,
+            text="Embedding Backend:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        backend_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.backend_var = tk.StringVar(value=OPENAI_BACKEND)
+        backend_menu = ttk.Combobox(
+            options_frame,
+            textvariable=self.backend_var,
+            values=[OPENAI_BACKEND, LOCAL_BACKEND],
+            state="readonly",
+            width=20,
+        )
+        backend_menu.pack(side=tk.LEFT)
+
+        dimensions_label = ttk.Label(
+            options_frame,
+            text="Embedding Dimensions:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        dimensions_label.pack(side=tk.LEFT, padx=(20, 10))
+
+        self.dimensions_var = tk.StringVar(value=str(FULL_EMBEDDING_DIMENSIONS))
+        dimensions_menu = ttk.Combobox(  # https://docs.python.org/3/library/tkinter.ttk.html#combobox
+            options_frame,
+            textvariable=self.dimensions_var,
+            values=EMBEDDING_DIMENSION_OPTIONS,
+            state="readonly",
+            width=8,
+        )
+        dimensions_menu.pack(side=tk.LEFT)
+
+        mode_label = ttk.Label(
+            options_frame,
+            text="Analysis Mode:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        mode_label.pack(side=tk.LEFT, padx=(20, 10))
+
+        self.mode_var = tk.StringVar(value=LEAVE_ONE_OUT_MODE)
+        mode_menu = ttk.Combobox(
+            options_frame,
+            textvariable=self.mode_var,
+            values=[LEAVE_ONE_OUT_MODE, ADAPTIVE_MODE],
+            state="readonly",
+            width=24,
+        )
+        mode_menu.pack(side=tk.LEFT)
+
+        self.fetch_responses_var = tk.BooleanVar(value=False)
+        fetch_responses_check = ttk.Checkbutton(  # model answers for the report, extra chat calls
+            options_frame,
+            text="Fetch responses for the report",
+            variable=self.fetch_responses_var,
+        )
+        fetch_responses_check.pack(side=tk.LEFT, padx=(20, 0))
+
         progress_frame = ttk.Frame(
             content_container
         )  # progress bar frame (not the bar)
@@ -155,6 +237,13 @@ class CosineSimilarityFrame(BaseFeatureFrame):
         )
         batch_button.pack(side=tk.RIGHT)
 
+        batch_heatmap_button = ttk.Button(
+            batch_frame,
+            text="Create All Heatmaps",
+            command=self.batch_create_heatmaps,
+        )
+        batch_heatmap_button.pack(side=tk.RIGHT, padx=5)
+
     def calculate_cosine_similarity(self, prompt, prompt_idx):# singel prompt calculation
         if not prompt.strip():
             messagebox.showwarning(
@@ -162,8 +251,8 @@ class CosineSimilarityFrame(BaseFeatureFrame):
             )
             return
 
-        api_key = self.api_key.get().strip() # check api key
-        if not api_key:
+        api_key = self.api_key.get().strip() # check api key, the local backend runs without one
+        if not api_key and self.backend_var.get() == OPENAI_BACKEND:
             messagebox.showwarning(
                 "API Key Required",
                 "Please enter your OpenAI API key in the homepage settings.",
@@ -192,9 +281,9 @@ class CosineSimilarityFrame(BaseFeatureFrame):
     def _calculate_cosine_similarity_thread(self, prompt, prompt_idx):
         try:
             api_key = self.api_key.get().strip()
-            max_tokens = 50 # remove for longer prompts
+            max_tokens = 50 # leave-one-out only, use adaptive mode for longer prompts
             model = "gpt-3.5-turbo"  # fixed model
-            embedding_model = "text-embedding-3-small"  # fixed embedding model
+            dimensions = int(self.dimensions_var.get())
 
             # Display initial status
             self.content_frame.after(
@@ -216,90 +305,116 @@ class CosineSimilarityFrame(BaseFeatureFrame):
                     for token in tokens_ids
                 ]
 
-                if len(tokens) > max_tokens:
+                adaptive = self.mode_var.get() == ADAPTIVE_MODE
+                if not adaptive and len(tokens) > max_tokens:  # adaptive mode has no cap
                     tokens_ids = tokens_ids[:max_tokens]
                     tokens = tokens[:max_tokens]
 
-                self.content_frame.after(
-                    0,
-                    lambda: self.update_status(
-                        prompt_idx, "Getting original embedding...", "#FFA500"
-                    ),
-                )
-
                 import openai
-                from openai import OpenAI
+                from utils.perturbation_planner import PerturbationPlan
 
-                client = OpenAI(api_key=api_key)
+                embedding_stats = {}
+                backend = self.create_embedding_backend(
+                    api_key, dimensions, embedding_stats
+                )
 
-                try:
-                    response = client.embeddings.create(
-                        input=[prompt], model=embedding_model
+                def embed(texts, on_chunk=None):
+                    # identical texts are only embedded once, the backend does the rest
+                    plan = PerturbationPlan()
+                    for n, text in enumerate(texts):
+                        plan.add(n, text)
+
+                    embeddings = backend.embed(plan.texts, on_chunk=on_chunk)
+                    embedding_stats["calls_saved"] = (
+                        embedding_stats.get("calls_saved", 0) + plan.calls_saved
                     )
-                    import numpy as np
+                    return plan.fan_out(embeddings)
 
-                    original_embedding = np.array(response.data[0].embedding)
+                def skip_token(token): # exclude tokens for importance calculations, remove if required
+                    return token.strip() in ["", " ", ".", ",", "!", "?"]
 
+                try:
                     self.content_frame.after(
                         0,
                         lambda: self.update_status(
-                            prompt_idx, "Analyzing token importance...", "#FFA500"
+                            prompt_idx, "Getting embeddings...", "#FFA500"
                         ),
                     )
 
-                    token_data = []
-                    total_tokens = len(tokens)
-
-                    for i, token in enumerate(tokens):
-                        try:
-                            progress_percentage = ((i + 1) / total_tokens) * 100
-                            self.content_frame.after(
-                                0,
-                                lambda p=progress_percentage: self.progress_var.set(p),
-                            )
-
-                            if token.strip() in ["", " ", ".", ",", "!", "?"]: # exclude tokens for importance calculations, remove if required
+                    if adaptive:
+                        original_embedding = embed([prompt])[0]
+
+                        # sentences / words first, only spans that matter are split further
+                        raw_scores, spans, adaptive_stats = adaptive_ablation(
+                            tokens_ids,
+                            tokens,
+                            enc.decode,
+                            lambda texts: cosine_importance(
+                                original_embedding, embed(texts)
+                            ),
+                            skip_token=skip_token,
+                            on_round=lambda done, total: self.content_frame.after(
+                                0, lambda p=(done / total) * 100: self.progress_var.set(p)
+                            ),
+                        )
+                        perturbations = list(enumerate(tokens))  # every position gets a score
+
+                        # a token's score comes from removing its whole final span, only the span
+                        # is kept, the report decodes the prompts it prints
+                        stored_perturbations = [
+                            {"position": i, "token": token, "start": spans[i][0], "end": spans[i][1]}
+                            for i, token in perturbations
+                            if spans[i] and not skip_token(token)
+                        ]
+                    else:
+                        perturbations = []  # (position, token) of every token that gets removed
+                        perturbed_texts = []
+                        for i, token in enumerate(tokens):
+                            if skip_token(token):
                                 continue
 
                             perturbed_tokens = tokens_ids.copy()
                             perturbed_tokens.pop(i)
                             perturbed_text = enc.decode(perturbed_tokens)
+                            if not perturbed_text:  # api rejects empty strings
+                                continue
 
-                            perturbed_response = client.embeddings.create(
-                                input=[perturbed_text], model=embedding_model
-                            )
-                            perturbed_embedding = np.array(
-                                perturbed_response.data[0].embedding
-                            )
-                            similarity = cosine_similarity(
-                                [original_embedding], [perturbed_embedding]
-                            )[0][0]
-                            importance_score = (
-                                1 - similarity
-                            )  # Higher score = more important
-
-                            token_data.append(
-                                {
-                                    "token": token,
-                                    "importance": float(importance_score),
-                                    "position": i,
-                                }
-                            )
-                        except Exception as token_error:
-                            print(f"Error processing token {token}: {str(token_error)}")
-                            # Continue with next token instead of failing the entire process
-
-                    if token_data:
-                        importance_values = [td["importance"] for td in token_data]
-                        min_value = min(importance_values)
-                        max_value = max(importance_values)
-
-                        # no division by zero
-                        if max_value > min_value:
-                            for td in token_data:
-                                td["importance"] = (td["importance"] - min_value) / (
-                                    max_value - min_value
-                                )
+                            perturbations.append((i, token))
+                            perturbed_texts.append(perturbed_text)
+
+                        embeddings = embed(
+                            [prompt] + perturbed_texts,
+                            on_chunk=lambda done, total: self.content_frame.after(
+                                0, lambda p=(done / total) * 100: self.progress_var.set(p)
+                            ),
+                        )
+                        # one matrix-vector product scores every perturbation, higher = more important
+                        raw_scores = cosine_importance(embeddings[0], embeddings[1:])
+                        adaptive_stats = None
+                        stored_perturbations = [  # what the report writer prints
+                            {"position": i, "token": token, "text": text}
+                            for (i, token), text in zip(perturbations, perturbed_texts)
+                        ]
+
+                    self.content_frame.after(
+                        0,
+                        lambda: self.update_status(
+                            prompt_idx, "Analyzing token importance...", "#FFA500"
+                        ),
+                    )
+
+                    importance_scores = min_max_normalize(raw_scores)
+
+                    token_data = [
+                        {
+                            "token": token,
+                            "importance": float(importance_score),
+                            "position": i,
+                        }
+                        for (i, token), importance_score in zip(
+                            perturbations, importance_scores
+                        )
+                    ]
 
                     # Sort results by importance (descending)
                     token_data.sort(key=lambda x: x["importance"], reverse=True)
@@ -309,13 +424,46 @@ class CosineSimilarityFrame(BaseFeatureFrame):
                     report = {
                         "prompt": prompt,
                         "tokens": token_data,
+                        "token_ids": list(tokens_ids),
                         "timestamp": timestamp,
                         "model": model,
-                        "embedding_model": embedding_model,
+                        "embedding_backend": backend.name,
+                        "embedding_model": backend.model_name,
+                        "dimensions": dimensions,
+                        "analysis_mode": "adaptive" if adaptive else "leave_one_out",
+                        "embedding_requests": embedding_stats.get("api_requests", 0),
+                        "embedding_cache_hits": embedding_stats.get("cache_hits", 0),
+                        "calls_saved": embedding_stats.get("calls_saved", 0),
+                        "perturbations": stored_perturbations,
                         "api_key": api_key,  
                     }
+                    if adaptive_stats:
+                        report["adaptive_rounds"] = adaptive_stats["rounds"]
+                        report["spans_scored"] = adaptive_stats["spans_scored"]
+
+                    if self.fetch_responses_var.get() and api_key:
+                        self.content_frame.after(
+                            0,
+                            lambda: self.update_status(
+                                prompt_idx, "Fetching responses...", "#FFA500"
+                            ),
+                        )
+                        from features.methods.cosine_similarity.responses import (
+                            add_missing_responses,
+                        )
+
+                        # capped to the most important tokens, saving the report retries failures
+                        response_error = add_missing_responses(
+                            report,
+                            on_response=lambda done, total: self.content_frame.after(
+                                0, lambda p=(done / total) * 100: self.progress_var.set(p)
+                            ),
+                        )
+                        if response_error:
+                            print(f"Error fetching responses: {response_error}")
 
                     self.result_data[prompt_idx] = report
+                    self.export_result(report)
 
                     self.content_frame.after( # buffer
                         100, lambda: self.update_ui_after_calculation(prompt_idx, True)
@@ -339,6 +487,39 @@ class CosineSimilarityFrame(BaseFeatureFrame):
                 lambda: self.update_ui_after_calculation(prompt_idx, False, error_msg),
             )
 
+    def create_embedding_backend(self, api_key, dimensions, stats):
+        if self.backend_var.get() == LOCAL_BACKEND:
+            # idf is fitted on the whole dataset so scores stay comparable across prompts
+            if (
+                self.local_backend is None
+                or self.local_backend.n_features != dimensions
+            ):
+                from utils.data_handler import load_custom_dataset
+
+                self.local_backend = LocalNgramEmbeddingBackend(
+                    n_features=dimensions
+                ).fit(load_custom_dataset() or self.prompts)
+            return self.local_backend
+
+        from utils.embedding_cache import get_embedding_cache
+
+        return OpenAIEmbeddingBackend(
+            api_key,
+            # full width is the model default, no need to ask for it
+            dimensions=None if dimensions == FULL_EMBEDDING_DIMENSIONS else dimensions,
+            cache=get_embedding_cache(),  # earlier runs come from the cache in storage/
+            stats=stats,
+        )
+
+    def export_result(self, report):
+        # machine readable copy in storage/results, a failed export doesn't fail the analysis
+        try:
+            from utils.results_exporter import get_results_exporter
+
+            get_results_exporter().add("cosine", report)
+        except Exception as e:
+            print(f"Error exporting result: {str(e)}")
+
     def update_status(self, prompt_idx, message, color="#FFFFFF"):
         if prompt_idx in self.status_vars:
             self.status_vars[prompt_idx].set(message)
@@ -374,6 +555,8 @@ class CosineSimilarityFrame(BaseFeatureFrame):
         if calculate_button:
             calculate_button.config(state="normal")
 
+        self.record_batch_report(prompt_idx, success, error_msg)
+
         if success: # basically just make the buttons clickable now that the calculation is done
             self.update_status(prompt_idx, "Completed", "#4CAF50") 
             self.progress_var.set(100)
@@ -493,23 +676,37 @@ class CosineSimilarityFrame(BaseFeatureFrame):
         if not file_path:
             return  
 
-        try:
-            from features.methods.cosine_similarity.report_writer import (
-                write_token_importance_report,
-            )
-
-            success = write_token_importance_report(file_path, result)
+        fetch_missing = self.fetch_responses_var.get()
 
+        def report_saved(success, error_msg=None):
             if success:
                 messagebox.showinfo(
                     "Download Complete", f"Report saved successfully to {file_path}"
                 )
+            elif error_msg:
+                messagebox.showerror("Error", f"Failed to save report: {error_msg}")
             else:
                 messagebox.showerror(
                     "Error", "Failed to save report. Please try again."
                 )
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save report: {str(e)}")
+
+        def save_report():
+            # fetching missing answers can take a while, so it runs off the tk thread
+            try:
+                from features.methods.cosine_similarity.report_writer import (
+                    write_token_importance_report,
+                )
+
+                # answers that weren't fetched during the analysis are fetched now if the option is on
+                success = write_token_importance_report(
+                    file_path, result, fetch_missing=fetch_missing
+                )
+                self.content_frame.after(0, lambda: report_saved(success))
+            except Exception as e:
+                error_msg = str(e)
+                self.content_frame.after(0, lambda: report_saved(False, error_msg))
+
+        threading.Thread(target=save_report, daemon=True).start()
 
     def create_heatmap(self, prompt_idx):
         result = self.result_data.get(prompt_idx)
@@ -529,24 +726,135 @@ class CosineSimilarityFrame(BaseFeatureFrame):
 
         if not file_path:
             return 
-        try:
-            from features.methods.cosine_similarity.heatmap_generator import (
-                generate_token_heatmap,
-            )
-
-            success = generate_token_heatmap(result, file_path)
+        heatmap_button = self.status_vars.get(f"heatmap_button_{prompt_idx}")
+        if heatmap_button:  # one render per prompt at a time
+            heatmap_button.config(state="disabled")
+        self.update_status(prompt_idx, "Rendering heatmap...", "#FFA500")
 
+        def on_done(success, error_msg):
+            # back on the tk thread once the worker process has written the png
+            if heatmap_button:
+                heatmap_button.config(state="normal")
+            self.update_status(prompt_idx, "Completed", "#4CAF50")
             if success:
                 messagebox.showinfo(
                     "Heatmap Created",
                     f"Heatmap visualization saved successfully to {file_path}",
                 )
             else:
-                messagebox.showerror(
-                    "Error", "Failed to create heatmap. Please try again."
+                messagebox.showerror("Error", f"Failed to create heatmap: {error_msg}")
+
+        try:
+            from utils.heatmap_renderer import get_heatmap_renderer
+
+            get_heatmap_renderer().render(
+                "cosine", result, file_path, self.content_frame, on_done
+            )
+        except Exception as e:
+            on_done(False, str(e))
+
+    def batch_create_heatmaps(self):
+        # every finished prompt, rendered in parallel by the worker processes
+        results = sorted(self.result_data.items())
+        if not results:
+            messagebox.showwarning(
+                "No Data", "No analysis data available yet. Calculate some prompts first."
+            )
+            return
+
+        folder = filedialog.askdirectory(title="Choose a Folder for the Heatmaps")
+        if not folder:
+            return
+
+        remaining = [len(results)]
+        failed = []
+
+        def on_done(prompt_idx, success, error_msg):
+            remaining[0] -= 1
+            if not success:
+                failed.append(f"Prompt {prompt_idx}: {error_msg}")
+            if remaining[0] == 0:
+                message = f"{len(results) - len(failed)} of {len(results)} heatmaps saved to {folder}"
+                if failed:
+                    message += "\n\n" + "\n".join(failed[:5])
+                messagebox.showinfo("Heatmaps Created", message)
+
+        try:
+            from utils.heatmap_renderer import get_heatmap_renderer
+
+            renderer = get_heatmap_renderer()
+            for prompt_idx, result in results:
+                renderer.render(
+                    "cosine",
+                    result,
+                    os.path.join(folder, f"prompt_{prompt_idx}_cosine_heatmap.png"),
+                    self.content_frame,
+                    lambda success, error_msg, idx=prompt_idx: on_done(idx, success, error_msg),
                 )
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to create heatmap: {str(e)}")
+            messagebox.showerror("Error", f"Failed to create heatmaps: {str(e)}")
+
+    def start_batch_report(self, prompt_indices):
+        # optional, one report for the whole batch, written as each prompt finishes
+        self.close_batch_report()  # previous batch not finished, close its file as it is
+
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[
+                ("Text files", "*.txt"),
+                ("Zip of per prompt reports", "*.zip"),
+                ("All files", "*.*"),
+            ],
+            title="Save Batch Report (Cancel to skip)",
+        )
+        if not file_path:
+            return
+
+        try:
+            from utils.batch_report import BatchReportWriter
+            from features.methods.cosine_similarity.report_writer import (
+                write_token_report_to,
+            )
+
+            self.batch_report = BatchReportWriter(
+                file_path, write_token_report_to, "TOKEN IMPORTANCE ANALYSIS"
+            )
+            self.batch_report_pending = set(prompt_indices)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to create batch report: {str(e)}")
+
+    def record_batch_report(self, prompt_idx, success, error_msg=None):
+        # main thread, called when a prompt of the batch finishes
+        if self.batch_report is None or prompt_idx not in self.batch_report_pending:
+            return
+
+        self.batch_report_pending.discard(prompt_idx)
+        try:
+            if success:
+                self.batch_report.add(prompt_idx, self.result_data[prompt_idx])
+            else:
+                self.batch_report.add_failure(prompt_idx, error_msg or "Unknown error")
+
+            if not self.batch_report_pending:  # last prompt, write the summary
+                self.batch_report.close()
+                messagebox.showinfo(
+                    "Batch Report Complete",
+                    f"Batch report saved to {self.batch_report.file_path}",
+                )
+                self.batch_report = None
+        except Exception as e:
+            self.close_batch_report()
+            messagebox.showerror("Error", f"Failed to write batch report: {str(e)}")
+
+    def close_batch_report(self):
+        # releases the batch report file with whatever was written so far
+        if self.batch_report is None:
+            return
+        try:
+            self.batch_report.close()  # no-op if it was already closed
+        except Exception as e:
+            print(f"Error closing batch report: {str(e)}")
+        self.batch_report = None
 
     def batch_calculate_all(self):  # all prompts
         confirm = messagebox.askyesno(
@@ -559,16 +867,24 @@ class CosineSimilarityFrame(BaseFeatureFrame):
 
         # get the api key
         api_key = self.api_key.get().strip()
-        if not api_key:
+        if not api_key and self.backend_var.get() == OPENAI_BACKEND:
             messagebox.showwarning(
                 "API Key Required",
                 "Please enter your OpenAI API key in the homepage settings.",
             )
             return
 
-        for i, prompt in enumerate(self.prompts, 1):
-            if not prompt.strip():  # empty prompts
-                continue
+        self.start_batch_report(
+            [i for i, prompt in enumerate(self.prompts, 1) if prompt.strip()]
+        )
 
-            self.calculate_cosine_similarity(prompt, i)
-            time.sleep(0.2)  # delay to avoid freezing
+        try:
+            for i, prompt in enumerate(self.prompts, 1):
+                if not prompt.strip():  # empty prompts
+                    continue
+
+                self.calculate_cosine_similarity(prompt, i)
+                time.sleep(0.2)  # delay to avoid freezing
+        except Exception:
+            self.close_batch_report()  # the remaining prompts never report back
+            raise
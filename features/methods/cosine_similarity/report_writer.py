@@ -1,133 +1,143 @@
 # cosine report writer
-def write_token_importance_report(file_path, result_data):
+# only writes what the analysis stored, the perturbed prompts and (if they were fetched) the
+# model responses, fetch_missing=True gets the missing responses first, concurrently and cached
+# adaptive results only keep the removed spans, their prompts are decoded here and every span
+# is printed once, under the most important token it scored
+from features.methods.cosine_similarity.responses import (
+    add_missing_responses,
+    perturbation_text,
+    removed_span,
+    removed_text,
+)
+
+
+def write_token_importance_report(file_path, result_data, fetch_missing=False):
     try:
+        response_error = None
+        if fetch_missing:
+            response_error = add_missing_responses(result_data)
+
         with open(file_path, "w", encoding="utf-8") as f:
-            f.write("TOKEN IMPORTANCE ANALYSIS\n")
-            f.write("=" * 50 + "\n\n")
+            write_token_report_to(f, result_data, response_error)
+        return True
+    except Exception as e:
+        print(f"Error writing report: {str(e)}")
+        return False
 
-            f.write(f"Analysis Date: {result_data.get('timestamp', 'Unknown')}\n")
-            f.write(f"Model: {result_data.get('model', 'Unknown')}\n")
+
+def write_token_report_to(f, result_data, response_error=None):
+    # writes into an open text file, also used for the batch reports
+    f.write("TOKEN IMPORTANCE ANALYSIS\n")
+    f.write("=" * 50 + "\n\n")
+
+    f.write(f"Analysis Date: {result_data.get('timestamp', 'Unknown')}\n")
+    f.write(f"Model: {result_data.get('model', 'Unknown')}\n")
+    if "embedding_backend" in result_data:
+        f.write(f"Embedding Backend: {result_data['embedding_backend']}\n")
+    f.write(
+        f"Embedding Model: {result_data.get('embedding_model', 'Unknown')}\n"
+    )
+    if "analysis_mode" in result_data:
+        f.write(f"Analysis Mode: {result_data['analysis_mode']}\n")
+    if "adaptive_rounds" in result_data:
+        f.write(
+            f"Adaptive Rounds: {result_data['adaptive_rounds']} "
+            f"(spans scored: {result_data.get('spans_scored', 0)})\n"
+        )
+    if "dimensions" in result_data:
+        f.write(f"Embedding Dimensions: {result_data['dimensions']}\n")
+    if "embedding_requests" in result_data:
+        f.write(
+            f"Embedding Requests: {result_data['embedding_requests']} "
+            f"(cache hits: {result_data.get('embedding_cache_hits', 0)})\n"
+        )
+    if "calls_saved" in result_data:
+        f.write(
+            f"Duplicate Perturbations Skipped: {result_data['calls_saved']}\n"
+        )
+    f.write("\n")
+
+    f.write("ORIGINAL PROMPT:\n")
+    f.write("-" * 50 + "\n")
+    original_prompt = result_data.get("prompt", "Unknown")
+    f.write(f"{original_prompt}\n\n")
+
+    original_response = result_data.get("original_response", "")
+    if original_response:
+        f.write("ORIGINAL API RESPONSE:\n")
+        f.write("-" * 50 + "\n")
+        f.write(f"{original_response}\n\n")
+
+    f.write("TOKEN IMPORTANCE ANALYSIS:\n")
+    f.write("-" * 50 + "\n")
+    f.write(f"{'TOKEN':<20} {'IMPORTANCE':<15} {'POSITION':<10}\n")
+    f.write("-" * 50 + "\n")
+
+    tokens = result_data.get("tokens", [])
+
+    sorted_tokens = sorted(
+        tokens, key=lambda x: x.get("importance", 0), reverse=True
+    )
+
+    for token_data in sorted_tokens:
+        token = token_data.get("token", "").replace("\n", "\\n")[:20]
+        importance = token_data.get("importance", 0)
+        position = token_data.get("position", 0)
+
+        f.write(f"{token:<20} {importance:<15.4f} {position:<10}\n")
+
+    perturbations = result_data.get("perturbations")
+    if perturbations is None:
+        f.write(
+            "\nNote: no perturbed prompts stored with this result, re-run the analysis to include them.\n"
+        )
+        return
+
+    if result_data.get("analysis_mode") == "adaptive":
+        f.write("\nPROMPTS WITH TOKEN SPANS REMOVED AND THEIR RESPONSES:\n")
+    else:
+        f.write("\nPROMPTS WITH INDIVIDUAL TOKENS REMOVED AND THEIR RESPONSES:\n")
+    f.write("=" * 50 + "\n\n")
+
+    if response_error:
+        f.write(f"NOTE: {response_error}\n\n")
+    answered = sum(1 for p in perturbations if "response" in p)
+    if 0 < answered < len(perturbations):
+        f.write(f"NOTE: responses were only fetched for the {answered} most important tokens.\n\n")
+
+    by_position = {p["position"]: p for p in perturbations}
+    written_spans = set()
+    for token_data in sorted_tokens:
+        perturbation = by_position.get(token_data.get("position"))
+        if perturbation is None:  # skipped token, nothing was removed
+            continue
+        start, end = removed_span(perturbation)
+        if (start, end) in written_spans:  # same prompt as a more important token
+            continue
+        written_spans.add((start, end))
+
+        display_token = (
+            removed_text(result_data, perturbation).replace("\n", "\\n").replace("\t", "\\t")
+        )
+        if display_token.isspace():
+            display_token = f"[whitespace]"
+
+        if end - start == 1:
+            removed = "TOKEN"
             f.write(
-                f"Embedding Model: {result_data.get('embedding_model', 'Unknown')}\n\n"
+                f"TOKEN REMOVED: '{display_token}' (Position: {start}, Importance: {token_data.get('importance', 0):.4f})\n"
             )
-
-            f.write("ORIGINAL PROMPT:\n")
-            f.write("-" * 50 + "\n")
-            original_prompt = result_data.get("prompt", "Unknown")
-            f.write(f"{original_prompt}\n\n")
-
-            original_response = result_data.get("original_response", "")
-            if original_response:
-                f.write("ORIGINAL API RESPONSE:\n")
-                f.write("-" * 50 + "\n")
-                f.write(f"{original_response}\n\n")
-
-            f.write("TOKEN IMPORTANCE ANALYSIS:\n")
-            f.write("-" * 50 + "\n")
-            f.write(f"{'TOKEN':<20} {'IMPORTANCE':<15} {'POSITION':<10}\n")
-            f.write("-" * 50 + "\n")
-
-            tokens = result_data.get("tokens", [])
-
-            sorted_tokens = sorted(
-                tokens, key=lambda x: x.get("importance", 0), reverse=True
+        else:
+            removed = "SPAN"
+            f.write(
+                f"SPAN REMOVED: '{display_token}' (Positions: {start}-{end - 1}, Importance per token: {token_data.get('importance', 0):.4f})\n"
             )
+        f.write("-" * 50 + "\n")
+        f.write(f"MODIFIED PROMPT:\n{perturbation_text(result_data, perturbation)}\n\n")
 
-            for token_data in sorted_tokens:
-                token = token_data.get("token", "").replace("\n", "\\n")[:20]
-                importance = token_data.get("importance", 0)
-                position = token_data.get("position", 0)
-
-                f.write(f"{token:<20} {importance:<15.4f} {position:<10}\n")
-
-            try:
-                import tiktoken
-                from openai import OpenAI
-
-                enc = tiktoken.encoding_for_model(
-                    result_data.get("model", "gpt-3.5-turbo")
-                )
-                token_ids = enc.encode(original_prompt)
-                original_tokens = [
-                    enc.decode_single_token_bytes(token).decode(
-                        "utf-8", errors="ignore"
-                    )
-                    for token in token_ids
-                ]
-
-                f.write(
-                    "\nPROMPTS WITH INDIVIDUAL TOKENS REMOVED AND THEIR RESPONSES:\n"
-                )
-                f.write("=" * 50 + "\n\n")
-
-                api_key = result_data.get("api_key", "")
-                can_get_responses = bool(api_key)
-
-                if not can_get_responses:
-                    f.write(
-                        "NOTE: API responses not available - API key not provided in result data.\n\n"
-                    )
-
-                client = None
-                if can_get_responses:
-                    try:
-                        client = OpenAI(api_key=api_key)
-                    except Exception as e:
-                        f.write(
-                            f"ERROR: Could not initialize OpenAI client: {str(e)}\n\n"
-                        )
-                        can_get_responses = False
-
-                for token_data in sorted_tokens:
-                    token_text = token_data.get("token", "")
-                    position = token_data.get("position")
-                    importance = token_data.get("importance", 0)
-
-                    if position is None:
-                        continue
-
-                    new_tokens = original_tokens.copy()
-                    if position < len(new_tokens):
-                        display_token = token_text.replace("\n", "\\n").replace(
-                            "\t", "\\t"
-                        )
-                        if display_token.isspace():
-                            display_token = f"[whitespace]"
-
-                        new_prompt = "".join(new_tokens)
-
-                        f.write(
-                            f"TOKEN REMOVED: '{display_token}' (Position: {position}, Importance: {importance:.4f})\n"
-                        )
-                        f.write("-" * 50 + "\n")
-                        f.write(f"MODIFIED PROMPT:\n{new_prompt}\n\n")
-
-                        if can_get_responses and client:
-                            try:
-                                response = client.chat.completions.create(
-                                    model=result_data.get("model", "gpt-3.5-turbo"),
-                                    messages=[{"role": "user", "content": new_prompt}],
-                                    temperature=0,
-                                )
-
-                                response_text = response.choices[0].message.content
-                                f.write(f"API RESPONSE WITH TOKEN REMOVED:\n")
-                                f.write("-" * 50 + "\n")
-                                f.write(f"{response_text}\n\n")
-
-                            except Exception as e:
-                                f.write(f"ERROR GETTING RESPONSE: {str(e)}\n\n")
-
-                        f.write("=" * 50 + "\n\n")
-
-            except ImportError as e:
-                f.write(
-                    f"\nNote: Could not generate prompts with tokens removed - required package not found: {str(e)}.\n"
-                )
-            except Exception as e:
-                f.write(f"\nError generating prompts with tokens removed: {str(e)}\n")
+        if "response" in perturbation:
+            f.write(f"API RESPONSE WITH {removed} REMOVED:\n")
+            f.write("-" * 50 + "\n")
+            f.write(f"{perturbation['response']}\n\n")
 
-        return True
-    except Exception as e:
-        print(f"Error writing report: {str(e)}")
-        return False
+        f.write("=" * 50 + "\n\n")
@@ -0,0 +1,124 @@
+# cosine responses
+# model answers to the original and perturbed prompts, only for the report (they don't affect the scores)
+# fetched on the worker pool through the completion cache, so saving a report twice or re-running
+# a prompt doesn't repeat any call
+# only the MAX_RESPONSES most important perturbations are answered and every answer is capped
+# at RESPONSE_MAX_TOKENS, so a long prompt can't turn into hundreds of open ended calls
+# https://platform.openai.com/docs/api-reference/chat/create
+
+from utils.completion_cache import MISSING, get_completion_cache, make_completion_key
+from utils.perturbation_planner import PerturbationPlan
+from utils.request_pool import DEFAULT_CONCURRENCY, run_concurrently
+
+RESPONSE_TEMPERATURE = 0
+RESPONSE_MAX_TOKENS = 256
+MAX_RESPONSES = 50  # perturbed prompts answered per result, most important tokens first
+
+
+def removed_span(perturbation):
+    # (start, end) of the tokens that were removed, adaptive results remove whole spans
+    start = perturbation.get("start", perturbation["position"])
+    return start, perturbation.get("end", start + 1)
+
+
+def decode_tokens(result_data, token_ids):
+    import tiktoken
+
+    enc = tiktoken.encoding_for_model(result_data.get("model", "gpt-3.5-turbo"))
+    return enc.decode(token_ids)
+
+
+def removed_text(result_data, perturbation):
+    # what was taken out of the prompt
+    start, end = removed_span(perturbation)
+    if end - start == 1:
+        return perturbation["token"]
+    return decode_tokens(result_data, result_data.get("token_ids", [])[start:end])
+
+
+def perturbation_text(result_data, perturbation):
+    # the prompt with the token (or span) removed, adaptive results only store the span
+    if "text" in perturbation:
+        return perturbation["text"]
+
+    token_ids = result_data.get("token_ids", [])
+    start, end = removed_span(perturbation)
+    return decode_tokens(result_data, token_ids[:start] + token_ids[end:])
+
+
+def fetch_responses(client, model, texts, max_workers=DEFAULT_CONCURRENCY, on_response=None):
+    # one answer per text, identical texts are only requested once
+    cache = get_completion_cache()
+    plan = PerturbationPlan()
+    for n, text in enumerate(texts):
+        plan.add(n, text)
+
+    def respond(text):
+        key = make_completion_key(  # no system prompt
+            model, "", RESPONSE_MAX_TOKENS, RESPONSE_TEMPERATURE, text
+        )
+        response = cache.get(key, MISSING)
+        if response is MISSING:
+            completion = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": text}],
+                max_tokens=RESPONSE_MAX_TOKENS,
+                temperature=RESPONSE_TEMPERATURE,
+            )
+            response = completion.choices[0].message.content or ""
+            cache.put(key, response)
+        return response
+
+    responses = [None] * len(plan.texts)
+    for done, (index, response) in enumerate(
+        run_concurrently(respond, plan.texts, max_workers), 1
+    ):
+        responses[index] = response
+        if on_response:
+            on_response(done, len(plan.texts))
+
+    return plan.fan_out(responses)
+
+
+def add_missing_responses(result_data, max_workers=DEFAULT_CONCURRENCY, on_response=None):
+    # fills in original_response and the response of the MAX_RESPONSES most important stored
+    # perturbations that have none, returns an error message for the report, or None
+    importance = {t["position"]: t.get("importance", 0) for t in result_data.get("tokens", [])}
+    perturbations = sorted(
+        result_data.get("perturbations", []),
+        key=lambda p: importance.get(p["position"], 0),
+        reverse=True,
+    )[:MAX_RESPONSES]
+    missing = [p for p in perturbations if "response" not in p]
+    need_original = not result_data.get("original_response")
+    if not missing and not need_original:
+        return None
+
+    api_key = result_data.get("api_key", "")
+    if not api_key:
+        return "API responses not available - API key not provided in result data."
+
+    try:
+        from openai import OpenAI
+
+        texts = [perturbation_text(result_data, p) for p in missing]
+        # removing a span that covers the whole prompt leaves nothing to send
+        missing = [p for p, text in zip(missing, texts) if text]
+        texts = [text for text in texts if text]
+        if need_original:
+            texts.append(result_data.get("prompt", ""))
+        responses = fetch_responses(
+            OpenAI(api_key=api_key),
+            result_data.get("model", "gpt-3.5-turbo"),
+            texts,
+            max_workers,
+            on_response,
+        )
+    except Exception as e:
+        return f"Could not get responses: {str(e)}"
+
+    if need_original:
+        result_data["original_response"] = responses.pop()
+    for perturbation, response in zip(missing, responses):
+        perturbation["response"] = response  # kept, the next save is free
+    return None
@@ -0,0 +1,37 @@
+# cosine scoring engine
+# scores every perturbed embedding against the original in one matrix-vector product
+# instead of a sklearn cosine_similarity call per token
+# https://numpy.org/doc/stable/reference/generated/numpy.linalg.norm.html
+
+import numpy as np
+
+
+def cosine_similarities(original_embedding, perturbed_embeddings):
+    original = np.asarray(original_embedding, dtype=np.float32)
+    original = original / max(np.linalg.norm(original), 1e-12)  # normalise once
+
+    matrix = np.asarray(perturbed_embeddings, dtype=np.float32)
+    if matrix.size == 0:
+        return np.zeros(0, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+
+    norms = np.linalg.norm(matrix, axis=1)
+    return (matrix @ original) / np.maximum(norms, 1e-12)
+
+
+def cosine_importance(original_embedding, perturbed_embeddings):
+    # higher score = removing the token moved the embedding further = more important
+    return 1.0 - cosine_similarities(original_embedding, perturbed_embeddings)
+
+
+def min_max_normalize(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return values
+
+    min_value = values.min()
+    max_value = values.max()
+    if max_value > min_value:  # no division by zero
+        return (values - min_value) / (max_value - min_value)
+    return values
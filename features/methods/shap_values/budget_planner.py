@@ -0,0 +1,187 @@
+# budget_planner.py
+# turns a completion call budget into a sampling plan for the SHAP estimators, estimates what a
+# run will cost (calls, tokens, time) before it starts and enforces the budget while it runs
+# cache hits are free, so every estimate here is the worst case of an empty cache
+# https://en.wikipedia.org/wiki/Water-filling_algorithm (splitting a batch budget)
+
+import math
+import threading
+
+DEFAULT_CALL_BUDGET = 200
+DEFAULT_SECONDS_PER_CALL = 0.8  # until a run has measured the real latency
+CHAT_OVERHEAD_TOKENS = 7  # message framing the api adds to every request
+FIXED_CALLS = 2  # baseline (empty prompt) and full prompt outputs, value functions can have fewer
+MIN_COALITION_CALLS = 2  # at least one coalition pair per prompt
+MIN_PROMPT_CALLS = FIXED_CALLS + MIN_COALITION_CALLS
+
+HEURISTIC_MAX_SAMPLES = 20
+HEURISTIC_PROBE_CAP = 3  # marginal contributions measured per token
+
+# how an estimator spends its calls
+HEURISTIC = "heuristic"  # fixed plan, shrunk to fit the budget
+SAMPLING = "sampling"  # keeps sampling until it converges or the budget runs out
+EXACT = "exact"  # all 2^n coalitions or nothing
+
+
+class BudgetExhausted(RuntimeError):
+    pass
+
+
+class CallBudget:
+    # thread safe count of completion calls, the hard cap for one prompt
+    def __init__(self, max_calls=None):
+        self.max_calls = max_calls  # None = no cap
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            if self.max_calls is not None and self.used >= self.max_calls:
+                raise BudgetExhausted(
+                    f"Call budget of {self.max_calls} completion calls used up"
+                )
+            self.used += 1
+
+
+def heuristic_coalition_sizes(total_tokens, max_samples=HEURISTIC_MAX_SAMPLES):
+    # coalition size -> number of coalitions sampled at that size
+    coalition_samples = {}  # Focus mainly on single-token and two-token effects
+
+    coalition_samples[0] = 1   #  check for empty coalition
+
+    coalition_samples[total_tokens - 1] = 1  # focus on single token removals (most informative)
+
+    remaining_samples = max_samples - 2 # add a few random small and medium-sized coalitions
+
+    if total_tokens > 2: # distribute remaining samples with focus on small coalitions
+        coalition_samples[1] = min(total_tokens, remaining_samples // 2) # single token
+        remaining_samples -= coalition_samples.get(1, 0)
+
+        if remaining_samples > 0 and total_tokens > 3:
+            mid_sizes = list(range(2, total_tokens - 1))
+            for size in mid_sizes:
+                if remaining_samples > 0:
+                    coalition_samples[size] = 1
+                    remaining_samples -= 1
+
+    return coalition_samples
+
+
+def heuristic_call_count(total_tokens, coalition_samples, probe_cap):
+    # upper bound, duplicate coalition texts make the real number smaller
+    if total_tokens == 0:
+        return 0
+    coalitions = sum(coalition_samples.values())
+    probes = sum(
+        count * (total_tokens - size)
+        for size, count in coalition_samples.items()
+        if size < total_tokens
+    )
+    return coalitions + min(probes, probe_cap * total_tokens)
+
+
+def heuristic_allocation(total_tokens, call_budget=None, fixed_calls=FIXED_CALLS):
+    # the largest plan (up to the old 20 samples, 3 probes per token) that fits the budget
+    max_samples = HEURISTIC_MAX_SAMPLES
+    probe_cap = HEURISTIC_PROBE_CAP
+    coalition_samples = heuristic_coalition_sizes(total_tokens, max_samples)
+
+    if call_budget is not None:
+        available = call_budget - fixed_calls
+        while heuristic_call_count(total_tokens, coalition_samples, probe_cap) > available:
+            if probe_cap > 1:  # fewer repeated measurements first
+                probe_cap -= 1
+            elif max_samples > 2:
+                max_samples -= 1
+            else:
+                break  # still too big, the plan gets cut off at the budget
+            coalition_samples = heuristic_coalition_sizes(total_tokens, max_samples)
+
+    return coalition_samples, probe_cap
+
+
+def calls_wanted(kind, total_tokens, fixed_calls=FIXED_CALLS):
+    # calls the estimator would make without a budget, None = as many as it is given
+    # fixed_calls = what the value function's prepare() makes before the coalitions
+    if kind == HEURISTIC:
+        coalition_samples, probe_cap = heuristic_allocation(total_tokens)
+        return fixed_calls + heuristic_call_count(total_tokens, coalition_samples, probe_cap)
+    if kind == EXACT:
+        return fixed_calls + 2 ** total_tokens
+    return None
+
+
+def exact_token_limit(call_budget, max_tokens, fixed_calls=FIXED_CALLS):
+    # most significant tokens exact mode covers on this budget (2^n coalitions plus the fixed calls)
+    if call_budget is None:
+        return max_tokens
+    available = call_budget - fixed_calls
+    if available < 1:
+        return 0
+    return min(available.bit_length() - 1, max_tokens)
+
+
+def planned_calls(kind, total_tokens, call_budget=None, fixed_calls=FIXED_CALLS):
+    wanted = calls_wanted(kind, total_tokens, fixed_calls)
+    if call_budget is None:
+        return wanted
+    if wanted is None:
+        return call_budget
+    return min(wanted, call_budget)
+
+
+def estimate_cost(
+    calls,
+    prompt_tokens,
+    significant_tokens,
+    system_prompt_tokens,
+    max_completion_tokens,
+    concurrency=1,
+    seconds_per_call=DEFAULT_SECONDS_PER_CALL,
+    fixed_completion_tokens=None,
+    fixed_calls=FIXED_CALLS,
+):
+    # coalitions keep the insignificant tokens and on average half of the significant ones
+    # fixed_completion_tokens = what the fixed calls generate, if it isn't max_completion_tokens each
+    tokens_per_request = (
+        CHAT_OVERHEAD_TOKENS + system_prompt_tokens + prompt_tokens - significant_tokens / 2
+    )
+    if fixed_completion_tokens is None:
+        fixed_completion_tokens = fixed_calls * max_completion_tokens
+    return {
+        "calls": calls,
+        "prompt_tokens": int(math.ceil(calls * tokens_per_request)),
+        "completion_tokens": (
+            max(calls - fixed_calls, 0) * max_completion_tokens + fixed_completion_tokens
+        ),
+        "seconds": math.ceil(calls / max(concurrency, 1)) * seconds_per_call,
+    }
+
+
+def split_budget(total_budget, demands, minimum=MIN_PROMPT_CALLS):
+    # equal shares, but a prompt never gets more than it wants (None = no limit)
+    # and whatever it doesn't need is handed to the others
+    # only as many prompts as can get the minimum are given a share, the rest get 0 (skipped)
+    shares = [0] * len(demands)
+    fits = len(demands) if minimum < 1 else min(len(demands), total_budget // minimum)
+    open_prompts = list(range(fits))
+    remaining = total_budget
+
+    while open_prompts and remaining > 0:
+        share = remaining // len(open_prompts)
+        if share == 0:  # fewer calls left than prompts, one each until they run out
+            for i in open_prompts[:remaining]:
+                shares[i] += 1
+            break
+
+        still_open = []
+        for i in open_prompts:
+            wanted = None if demands[i] is None else demands[i] - shares[i]
+            given = share if wanted is None else min(share, wanted)
+            shares[i] += given
+            remaining -= given
+            if wanted is None or wanted > given:
+                still_open.append(i)
+        open_prompts = still_open
+
+    return shares
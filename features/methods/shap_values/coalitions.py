@@ -0,0 +1,38 @@
+# coalitions.py
+# builds the prompt text of a coalition without going back through the tokenizer
+# the token bytes are split once per prompt into segments: the skipped tokens between two
+# significant tokens always stay, so the text is gap 0, player 0, gap 1, player 1, ... gap n
+# with the players that are left out dropped, joined as bytes and decoded once
+# coalitions are numpy boolean rows (the estimators) or int bitmasks, bit j = player j kept
+# https://github.com/openai/tiktoken/blob/main/tiktoken/core.py (decode_tokens_bytes)
+
+from itertools import compress
+
+import numpy as np
+
+
+class CoalitionTexts:
+    def __init__(self, token_bytes, player_positions):
+        # token_bytes from enc.decode_tokens_bytes, player j is the token at player_positions[j]
+        self.n_players = len(player_positions)
+        segments = []
+        start = 0
+        for position in player_positions:
+            segments.append(b"".join(token_bytes[start:position]))  # gap before the player
+            segments.append(token_bytes[position])
+            start = position + 1
+        segments.append(b"".join(token_bytes[start:]))
+        self.segments = segments
+        self._keep = np.ones(len(segments), dtype=bool)  # gaps are always kept
+
+    def from_mask(self, mask):
+        keep = self._keep.copy()
+        keep[1::2] = mask
+        # same as enc.decode on the kept token ids, so the cache keys don't change
+        return b"".join(compress(self.segments, keep)).decode("utf-8", errors="replace")
+
+    def from_bitmask(self, bitmask):
+        return self.from_mask([(bitmask >> j) & 1 for j in range(self.n_players)])
+
+    def from_masks(self, masks):
+        return [self.from_mask(mask) for mask in masks]
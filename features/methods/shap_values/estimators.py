@@ -0,0 +1,283 @@
+# Shapley value estimators for the SHAP frame
+# every estimator plays the same game: value_fn(masks) takes a boolean array
+# (coalitions x tokens, True = token kept in the prompt) and returns one value per row
+# https://arxiv.org/abs/1705.07874 (KernelSHAP)
+# https://arxiv.org/abs/2012.01536 (paired sampling and the constrained solve)
+# https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm
+
+import math
+
+import numpy as np
+
+from features.methods.shap_values.budget_planner import BudgetExhausted
+
+BATCH_SIZE = 32  # coalitions per round, sent to the api together
+MAX_EVALUATIONS = 512
+DEFAULT_TOLERANCE = 0.1  # widest 95% confidence interval allowed, relative to the spread of the values
+CONFIDENCE_Z = 1.96
+EXACT_MAX_PLAYERS = 14  # 2^14 = 16384 coalitions, anything above that is sampled instead
+
+
+def coalition_masks(n_players):
+    # row b is the coalition with bitmask b, bit i set = player i kept
+    bitmasks = np.arange(2 ** n_players, dtype=np.int64)
+    return (bitmasks[:, None] >> np.arange(n_players)) & 1 == 1
+
+
+def exact_shapley(value_fn, n_players, on_batch=None, error_fn=None):
+    # every coalition is evaluated once, then
+    # phi_i = sum over S with i of w(|S| - 1) v(S)  -  sum over S without i of w(|S|) v(S)
+    # with w(s) = s! (n - s - 1)! / n!, as two matrix products over the bitmask table
+    # returns (shapley value per player, 95% confidence interval width or None, run stats)
+    # there is no sampling error over coalitions, but if the values themselves are noisy
+    # error_fn(masks) gives their standard errors, which are carried through the same weights
+    if n_players > EXACT_MAX_PLAYERS:
+        raise ValueError(
+            f"Exact Shapley values need 2^{n_players} coalitions, "
+            f"use a sampling estimator above {EXACT_MAX_PLAYERS} tokens"
+        )
+
+    stats = {"evaluations": 0, "exact": True}
+    if n_players == 0:
+        return np.zeros(0), None, stats
+
+    masks = coalition_masks(n_players)
+    values = np.asarray(value_fn(masks), dtype=np.float64)
+    stats["evaluations"] = len(masks)
+    if on_batch:
+        on_batch(len(masks), len(masks))
+
+    sizes = masks.sum(axis=1)
+    weights = np.array(  # w(s) for s = 0 .. n - 1
+        [
+            math.factorial(size) * math.factorial(n_players - size - 1) / math.factorial(n_players)
+            for size in range(n_players)
+        ]
+    )
+
+    with_weight = np.zeros(len(masks))
+    with_weight[sizes > 0] = weights[sizes[sizes > 0] - 1]
+    without_weight = np.zeros(len(masks))
+    without_weight[sizes < n_players] = weights[sizes[sizes < n_players]]
+
+    with_matrix = masks.T.astype(np.float64)
+    without_matrix = (~masks).T.astype(np.float64)
+    phi = with_matrix @ (with_weight * values) - without_matrix @ (without_weight * values)
+
+    ci_width = None
+    errors = error_fn(masks) if error_fn else None
+    if errors is not None:  # independent errors, each coalition is in one of the two sums
+        variance = np.asarray(errors, dtype=np.float64) ** 2
+        ci_width = _ci_width(
+            np.sqrt(
+                with_matrix @ (with_weight ** 2 * variance)
+                + without_matrix @ (without_weight ** 2 * variance)
+            )
+        )
+    return phi, ci_width, stats
+
+
+def _ci_width(std_error):
+    return 2 * CONFIDENCE_Z * std_error
+
+
+def _narrow_enough(ci_width, values, tolerance):
+    return ci_width.max() < tolerance * max(np.ptp(values), 1e-12)
+
+
+def kernel_size_distribution(n_players):
+    # probability of each coalition size under the shapley kernel, sizes 0 and n are handled exactly
+    sizes = np.arange(1, n_players)
+    weights = (n_players - 1) / (sizes * (n_players - sizes))
+    return sizes, weights / weights.sum()
+
+
+def sample_kernel_coalitions(n_players, n_samples, rng):
+    # size drawn from the kernel, members uniformly, and every coalition comes with its complement
+    sizes, probabilities = kernel_size_distribution(n_players)
+    half = (n_samples + 1) // 2
+    drawn = rng.choice(sizes, size=half, p=probabilities)
+
+    ranks = rng.random((half, n_players)).argsort(axis=1).argsort(axis=1)  # random order per row
+    masks = ranks < drawn[:, None]
+    return np.concatenate([masks, ~masks])[:n_samples]
+
+
+def _constrained_solve(A, b, total):
+    # argmin phi^T A phi - 2 b^T phi  subject to  sum(phi) = total
+    # C maps an error in b to an error in phi, returned for the standard error
+    A_inv = np.linalg.pinv(A)
+    A_inv_1 = A_inv.sum(axis=1)
+    C = A_inv - np.outer(A_inv_1, A_inv_1) / A_inv_1.sum()
+    return C @ b + A_inv_1 * total / A_inv_1.sum(), C
+
+
+def kernel_shap(
+    value_fn,
+    n_players,
+    max_evaluations=MAX_EVALUATIONS,
+    batch_size=BATCH_SIZE,
+    tolerance=DEFAULT_TOLERANCE,
+    rng=None,
+    on_batch=None,
+):
+    # returns (shapley value per player, 95% confidence interval width per player, run stats)
+    stats = {"evaluations": 0, "batches": 0, "converged": False}
+    if n_players == 0:
+        return np.zeros(0), np.zeros(0), stats
+
+    v_empty, v_full = np.asarray(
+        value_fn(np.array([np.zeros(n_players, bool), np.ones(n_players, bool)])),
+        dtype=np.float64,
+    )
+    stats["evaluations"] = 2
+    total = v_full - v_empty  # efficiency: the values add up to this
+
+    if n_players == 1:
+        stats["converged"] = True
+        return np.array([total]), np.zeros(1), stats
+
+    rng = rng or np.random.default_rng()
+    batch_size = max(2, batch_size - batch_size % 2)  # keep the complement pairs together
+
+    A_sum = np.zeros((n_players, n_players))
+    b_sum = np.zeros(n_players)
+    sampled_z = []  # kept for the residuals, one array per batch
+    sampled_y = []
+    pairs = 0
+    phi = None
+    ci_width = None
+
+    while stats["evaluations"] + 2 <= max_evaluations:
+        remaining = max_evaluations - stats["evaluations"]
+        masks = sample_kernel_coalitions(
+            n_players, min(batch_size, remaining - remaining % 2), rng
+        )
+        try:
+            values = np.asarray(value_fn(masks), dtype=np.float64)
+        except BudgetExhausted:  # keep what the earlier batches measured
+            stats["budget_exhausted"] = True
+            break
+
+        # samples already follow the kernel distribution, so every row gets the same weight
+        z = masks.astype(np.float64)
+        y = values - v_empty
+        A_sum += (z.T @ z) / 2  # a coalition and its complement count as one sample
+        b_sum += (z.T @ y) / 2
+        sampled_z.append(z)
+        sampled_y.append(y)
+        pairs += len(masks) // 2
+        stats["evaluations"] += len(masks)
+        stats["batches"] += 1
+
+        phi, C = _constrained_solve(A_sum / pairs, b_sum / pairs, total)
+
+        if on_batch:
+            on_batch(stats["evaluations"], max_evaluations)
+
+        if pairs >= max(2 * n_players, 16):  # too few samples and the error estimate itself is noise
+            # sandwich estimate: spread of the per pair residual terms z * (y - z . phi)
+            residual_terms = []
+            for z, y in zip(sampled_z, sampled_y):
+                half = len(z) // 2
+                terms = z * (y - z @ phi)[:, None]
+                residual_terms.append((terms[:half] + terms[half:]) / 2)
+            residual_terms = np.concatenate(residual_terms)
+            covariance = np.cov(residual_terms, rowvar=False) / pairs
+            ci_width = _ci_width(np.sqrt(np.maximum(np.diag(C @ covariance @ C.T), 0)))
+            if _narrow_enough(ci_width, phi, tolerance):
+                stats["converged"] = True
+                break
+
+    if phi is None:  # budget too small to sample anything, split the total evenly
+        phi = np.full(n_players, total / n_players)
+
+    return phi, ci_width, stats
+
+
+def permutation_shapley(
+    value_fn,
+    n_players,
+    max_evaluations=MAX_EVALUATIONS,
+    batch_size=BATCH_SIZE,
+    tolerance=DEFAULT_TOLERANCE,
+    min_pairs=8,
+    rng=None,
+    on_batch=None,
+):
+    # every permutation walks its prefix coalitions, which gives one marginal contribution per
+    # player, and is paired with its reverse (antithetic) to cancel out most of the ordering noise
+    # returns (shapley value per player, 95% confidence interval width per player, run stats)
+    stats = {"evaluations": 0, "batches": 0, "converged": False, "permutations": 0}
+    if n_players == 0:
+        return np.zeros(0), np.zeros(0), stats
+
+    v_empty, v_full = np.asarray(
+        value_fn(np.array([np.zeros(n_players, bool), np.ones(n_players, bool)])),
+        dtype=np.float64,
+    )  # the first and last prefix of every permutation
+    stats["evaluations"] = 2
+
+    if n_players == 1:
+        stats["converged"] = True
+        return np.array([v_full - v_empty]), np.zeros(1), stats
+
+    rng = rng or np.random.default_rng()
+    pair_cost = 2 * (n_players - 1)  # inner prefixes of a permutation and its reverse
+    pairs_per_batch = max(1, batch_size // pair_cost)
+
+    count = 0  # welford state, one sample per player per antithetic pair
+    mean = np.zeros(n_players)
+    m2 = np.zeros(n_players)
+    ci_width = None
+    positions = np.arange(n_players)
+
+    while stats["evaluations"] + pair_cost <= max_evaluations:
+        n_pairs = min(pairs_per_batch, (max_evaluations - stats["evaluations"]) // pair_cost)
+        orders = np.array([rng.permutation(n_players) for _ in range(n_pairs)])
+        orders = np.concatenate([orders, orders[:, ::-1]])
+
+        ranks = np.empty_like(orders)  # position of each player in its permutation
+        ranks[np.arange(len(orders))[:, None], orders] = positions
+        masks = ranks[:, None, :] < np.arange(1, n_players)[None, :, None]  # inner prefixes
+
+        try:
+            inner = np.asarray(
+                value_fn(masks.reshape(-1, n_players)), dtype=np.float64
+            ).reshape(len(orders), n_players - 1)
+        except BudgetExhausted:  # keep what the earlier batches measured
+            stats["budget_exhausted"] = True
+            break
+        prefix_values = np.concatenate(
+            [np.full((len(orders), 1), v_empty), inner, np.full((len(orders), 1), v_full)],
+            axis=1,
+        )
+
+        # the player at position k adds prefix_values[k + 1] - prefix_values[k]
+        contributions = np.diff(prefix_values, axis=1)
+        by_player = np.take_along_axis(contributions, ranks, axis=1)
+        samples = (by_player[:n_pairs] + by_player[n_pairs:]) / 2
+
+        for sample in samples:
+            count += 1
+            delta = sample - mean
+            mean += delta / count
+            m2 += delta * (sample - mean)
+
+        stats["evaluations"] += masks.shape[0] * masks.shape[1]
+        stats["batches"] += 1
+        stats["permutations"] += len(orders)
+
+        if on_batch:
+            on_batch(stats["evaluations"], max_evaluations)
+
+        if count > 1:
+            ci_width = _ci_width(np.sqrt(m2 / (count - 1) / count))
+            if count >= min_pairs and _narrow_enough(ci_width, mean, tolerance):
+                stats["converged"] = True
+                break
+
+    if count == 0:  # budget too small for a single pair, split the total evenly
+        mean = np.full(n_players, (v_full - v_empty) / n_players)
+
+    return mean, ci_width, stats
@@ -1,12 +1,56 @@
 from frames.feature_frames import BaseFeatureFrame
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import os
 import threading
 import time
 from datetime import datetime
 import tiktoken
+import math
 import random
+import numpy as np
 from openai import OpenAI
+from features.methods.shap_values.budget_planner import (
+    DEFAULT_CALL_BUDGET,
+    DEFAULT_SECONDS_PER_CALL,
+    EXACT,
+    HEURISTIC,
+    MIN_COALITION_CALLS,
+    SAMPLING,
+    BudgetExhausted,
+    CallBudget,
+    calls_wanted,
+    estimate_cost,
+    exact_token_limit,
+    heuristic_allocation,
+    planned_calls,
+    split_budget,
+)
+from features.methods.shap_values.coalitions import CoalitionTexts
+from features.methods.shap_values.hierarchical import hierarchical_shapley
+from features.methods.shap_values.estimators import (
+    CONFIDENCE_Z,
+    DEFAULT_TOLERANCE,
+    EXACT_MAX_PLAYERS,
+    MAX_EVALUATIONS,
+    exact_shapley,
+    kernel_shap,
+    permutation_shapley,
+)
+from features.methods.shap_values.value_functions import (
+    DEFAULT_SAMPLING_TEMPERATURE,
+    MAX_SAMPLES,
+    SYSTEM_PROMPT,
+    VALUE_FUNCTIONS,
+)
+from utils.completion_cache import MISSING, get_completion_cache
+from utils.perturbation_planner import PerturbationPlan
+from utils.request_pool import (
+    DEFAULT_CONCURRENCY,
+    MAX_CONCURRENCY,
+    run_concurrently,
+    set_concurrency,
+)
 
 # code from cosine similarity frame was used for consistency 
 # PLEASE NOTE: The code that I have used in this file is adapted from the work of SHAP and TokenSHAP
@@ -21,6 +65,71 @@ from openai import OpenAI
 # https://docs.python.org/3/library/threading.html
 # 
 
+COMMON_TOKENS = [ # will be removed but commend out if not needed
+    " ",
+    ".",
+    ",",
+    "!",
+    "?",
+    ":",
+    ";",
+    ")",
+    "(",
+    '"',
+    "'",
+    "-",
+    "_",
+    "the",
+    "a",
+    "an",
+    "and",
+    "of",
+    "to",
+    "in",
+    "is",
+    "that",
+    "for",
+]
+
+
+def significant_token_positions(tokens):
+    significant_token_indices = []
+    for i, token in enumerate(tokens): # skip common tokens for less api calls
+        if token.lower() in COMMON_TOKENS or not token.strip():
+            continue
+        significant_token_indices.append(i)
+
+    max_significant_tokens = None
+    if (
+        max_significant_tokens
+        and len(significant_token_indices) > max_significant_tokens
+    ):
+        significant_token_indices = significant_token_indices[
+            :max_significant_tokens
+        ]  # 8  further reduced
+
+    return significant_token_indices
+
+
+HEURISTIC_ESTIMATOR = "Heuristic (fast)"
+KERNEL_ESTIMATOR = "KernelSHAP"
+PERMUTATION_ESTIMATOR = "Permutation sampling"
+EXACT_ESTIMATOR = "Exact (small prompts)"  # the token limit depends on the budget, shown next to it
+HIERARCHICAL_ESTIMATOR = "Hierarchical (long prompts)"
+SAMPLING_ESTIMATORS = {  # stop once every token's confidence interval is narrow enough
+    KERNEL_ESTIMATOR: kernel_shap,
+    PERMUTATION_ESTIMATOR: permutation_shapley,
+}
+MAX_CALL_BUDGET = calls_wanted(EXACT, EXACT_MAX_PLAYERS)  # enough for the largest exact run
+VALUE_FUNCTION_CLASSES = {value_class.label: value_class for value_class in VALUE_FUNCTIONS}
+ESTIMATOR_KINDS = {  # how each estimator spends its call budget
+    HEURISTIC_ESTIMATOR: HEURISTIC,
+    KERNEL_ESTIMATOR: SAMPLING,
+    PERMUTATION_ESTIMATOR: SAMPLING,
+    EXACT_ESTIMATOR: EXACT,
+    HIERARCHICAL_ESTIMATOR: SAMPLING,
+}
+
 
 class ShapValuesFrame(BaseFeatureFrame):
     def __init__(self, parent, controller):
@@ -28,7 +137,8 @@ class ShapValuesFrame(BaseFeatureFrame):
         self.prompts = (
             controller.random_prompts if hasattr(controller, "random_prompts") else []
         )
-        self.coalition_cache = {}  # cache for coalition outputs to reduce API call usage
+        self.seconds_per_call = DEFAULT_SECONDS_PER_CALL  # updated after every run
+        self.batch_report = None  # BatchReportWriter while a batch with a report is running
         super().__init__(parent, controller, "SHAP Values")
 
     def create_content(self):
@@ -49,6 +159,172 @@ class ShapValuesFrame(BaseFeatureFrame):
 
         self.prompt_frames = {} # for each prompt
 
+        options_frame = ttk.Frame(content_container)  # analysis settings
+        options_frame.pack(fill=tk.X, pady=10)
+
+        estimator_label = ttk.Label(
+            options_frame,
+            text="Estimator:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        estimator_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.estimator_var = tk.StringVar(value=HEURISTIC_ESTIMATOR)
+        estimator_menu = ttk.Combobox(
+            options_frame,
+            textvariable=self.estimator_var,
+            values=[
+                HEURISTIC_ESTIMATOR,
+                KERNEL_ESTIMATOR,
+                PERMUTATION_ESTIMATOR,
+                EXACT_ESTIMATOR,
+                HIERARCHICAL_ESTIMATOR,
+            ],
+            state="readonly",
+            width=24,
+        )
+        estimator_menu.pack(side=tk.LEFT)
+
+        tolerance_label = ttk.Label(
+            options_frame,
+            text="CI Tolerance:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        tolerance_label.pack(side=tk.LEFT, padx=(20, 10))
+
+        self.tolerance_var = tk.DoubleVar(value=DEFAULT_TOLERANCE)
+        tolerance_spinbox = ttk.Spinbox(  # widest confidence interval, as a fraction of the value range
+            options_frame,
+            from_=0.01,
+            to=0.5,
+            increment=0.01,
+            textvariable=self.tolerance_var,
+            width=5,
+        )
+        tolerance_spinbox.pack(side=tk.LEFT, padx=(0, 20))
+
+        value_function_label = ttk.Label(
+            options_frame,
+            text="Coalition Value:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        value_function_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.value_function_var = tk.StringVar(value=VALUE_FUNCTIONS[0].label)
+        value_function_menu = ttk.Combobox(  # what a coalition is scored by
+            options_frame,
+            textvariable=self.value_function_var,
+            values=list(VALUE_FUNCTION_CLASSES),
+            state="readonly",
+            width=32,
+        )
+        value_function_menu.pack(side=tk.LEFT, padx=(0, 20))
+
+        sampling_options_frame = ttk.Frame(content_container)  # one row would be too wide
+        sampling_options_frame.pack(fill=tk.X, pady=(0, 10))
+
+        samples_label = ttk.Label(
+            sampling_options_frame,
+            text="Samples:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        samples_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.samples_var = tk.IntVar(value=1)
+        samples_spinbox = ttk.Spinbox(  # answers per coalition from one request (n), output length only
+            sampling_options_frame,
+            from_=1,
+            to=MAX_SAMPLES,
+            textvariable=self.samples_var,
+            state="readonly",
+            width=4,
+        )
+        samples_spinbox.pack(side=tk.LEFT, padx=(0, 10))
+
+        temperature_label = ttk.Label(
+            sampling_options_frame,
+            text="Temperature:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        temperature_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.temperature_var = tk.DoubleVar(value=DEFAULT_SAMPLING_TEMPERATURE)
+        temperature_spinbox = ttk.Spinbox(  # only used with more than one sample
+            sampling_options_frame,
+            from_=0.0,
+            to=2.0,
+            increment=0.1,
+            textvariable=self.temperature_var,
+            width=4,
+        )
+        temperature_spinbox.pack(side=tk.LEFT, padx=(0, 20))
+
+        request_options_frame = ttk.Frame(content_container)  # how the calls are made
+        request_options_frame.pack(fill=tk.X, pady=(0, 10))
+
+        concurrency_label = ttk.Label(
+            request_options_frame,
+            text="Concurrent Requests:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        concurrency_label.pack(side=tk.LEFT, padx=(0, 10))
+
+        self.concurrency_var = tk.IntVar(value=DEFAULT_CONCURRENCY)
+        concurrency_spinbox = ttk.Spinbox(  # https://docs.python.org/3/library/tkinter.ttk.html#spinbox
+            request_options_frame,
+            from_=1,
+            to=MAX_CONCURRENCY,
+            textvariable=self.concurrency_var,
+            state="readonly",
+            width=5,
+        )
+        concurrency_spinbox.pack(side=tk.LEFT)
+
+        budget_label = ttk.Label(
+            request_options_frame,
+            text="Call Budget:",
+            font=("Helvetica", 14),
+            foreground="#FFFFFF",
+        )
+        budget_label.pack(side=tk.LEFT, padx=(20, 10))
+
+        self.budget_var = tk.IntVar(value=DEFAULT_CALL_BUDGET)
+        budget_spinbox = ttk.Spinbox(  # per prompt, split across all prompts in batch mode
+            request_options_frame,
+            from_=10,
+            to=MAX_CALL_BUDGET,
+            increment=10,
+            textvariable=self.budget_var,
+            width=6,
+        )
+        budget_spinbox.pack(side=tk.LEFT)
+
+        self.exact_limit_var = tk.StringVar()
+        exact_limit_label = ttk.Label(  # what exact mode can do on the current budget
+            request_options_frame,
+            textvariable=self.exact_limit_var,
+            font=("Helvetica", 12),
+            foreground="#FFFFFF",
+        )
+        exact_limit_label.pack(side=tk.LEFT, padx=(10, 0))
+        self.budget_var.trace_add("write", lambda *_: self.update_exact_limit())
+        self.value_function_var.trace_add("write", lambda *_: self.update_exact_limit())
+        self.update_exact_limit()
+
+        self.persist_cache_var = tk.BooleanVar(value=True)
+        persist_cache_check = ttk.Checkbutton(  # reuse coalition outputs across sessions
+            request_options_frame,
+            text="Keep completion cache in storage/",
+            variable=self.persist_cache_var,
+        )
+        persist_cache_check.pack(side=tk.LEFT, padx=(20, 0))
+
         progress_frame = ttk.Frame(content_container)
         progress_frame.pack(fill=tk.X, pady=10)
 
@@ -163,7 +439,14 @@ class ShapValuesFrame(BaseFeatureFrame):
         )
         batch_button.pack(side=tk.RIGHT)
 
-    def calculate_shap_values(self, prompt, prompt_idx):
+        batch_heatmap_button = ttk.Button(
+            batch_frame,
+            text="Create All Heatmaps",
+            command=self.batch_create_heatmaps,
+        )
+        batch_heatmap_button.pack(side=tk.RIGHT, padx=5)
+
+    def calculate_shap_values(self, prompt, prompt_idx, call_budget=None, confirm=True):
         if not prompt.strip():
             messagebox.showwarning(
                 "Empty Prompt", "The prompt is empty. Please enter a valid prompt."
@@ -178,6 +461,18 @@ class ShapValuesFrame(BaseFeatureFrame):
             )
             return
 
+        if call_budget is None:
+            call_budget = self.budget_var.get()
+
+        if confirm:  # show what the run will cost before any call is made
+            estimate = self.estimate_run(prompt, call_budget)
+            if estimate is None:
+                return
+            if not messagebox.askyesno(
+                "SHAP Cost Estimate", self.describe_estimate(estimate) + "\n\nProceed?"
+            ):
+                return
+
         calculate_button = self.status_vars.get(f"calculate_button_{prompt_idx}")
         if calculate_button:
             calculate_button.config(state="disabled")
@@ -187,18 +482,97 @@ class ShapValuesFrame(BaseFeatureFrame):
         )  # Orange for processing
 
         self.progress_var.set(0)
+        set_concurrency(self.concurrency_var.get())  # shared by every run, batch runs included
 
         thread = threading.Thread( # THIS IS VERY IMPORTANT so UI can run, and calculation in bg
-            target=self._calculate_shap_values_thread, args=(prompt, prompt_idx)
+            target=self._calculate_shap_values_thread,
+            args=(prompt, prompt_idx, call_budget),
         )
         thread.daemon = True
         thread.start()
 
-    def _calculate_shap_values_thread(self, prompt, prompt_idx):
+    def estimate_run(self, prompt, call_budget, show_warnings=True):
+        # worst case cost (nothing cached) of one prompt, None if it can't run in this mode
+        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        tokens = [
+            enc.decode_single_token_bytes(token).decode("utf-8", errors="ignore")
+            for token in enc.encode(prompt)
+        ]
+        total_tokens = len(significant_token_positions(tokens))
+        kind = ESTIMATOR_KINDS[self.estimator_var.get()]
+
+        if kind == EXACT:
+            reason = None
+            if total_tokens > EXACT_MAX_PLAYERS:
+                reason = f"The prompt has {total_tokens} significant tokens, exact mode supports up to {EXACT_MAX_PLAYERS}."
+            elif calls_wanted(kind, total_tokens, self.fixed_calls()) > call_budget:
+                reason = f"Exact mode needs {calls_wanted(kind, total_tokens, self.fixed_calls())} calls for this prompt but the budget is {call_budget}."
+            if reason:
+                if show_warnings:
+                    messagebox.showwarning("Budget Too Small", reason)
+                return None
+
+        return estimate_cost(
+            planned_calls(kind, total_tokens, call_budget, self.fixed_calls()),
+            len(tokens),
+            total_tokens,
+            len(enc.encode(SYSTEM_PROMPT)),
+            self.completion_tokens_per_call(),
+            concurrency=self.concurrency_var.get(),
+            seconds_per_call=self.seconds_per_call,
+            fixed_completion_tokens=self.prepare_completion_tokens(),
+            fixed_calls=self.fixed_calls(),
+        )
+
+    def update_exact_limit(self):
+        try:
+            call_budget = self.budget_var.get()
+        except tk.TclError:  # half typed value
+            return
+        limit = exact_token_limit(call_budget, EXACT_MAX_PLAYERS, self.fixed_calls())
+        self.exact_limit_var.set(f"(exact: up to {limit} tokens)")
+
+    def value_function_options(self):
+        # samples and temperature for value functions that support them
+        value_class = VALUE_FUNCTION_CLASSES[self.value_function_var.get()]
+        if not value_class.supports_samples or self.samples_var.get() <= 1:
+            return {}
+        return {
+            "samples": self.samples_var.get(),
+            "temperature": float(self.temperature_var.get()),
+        }
+
+    def completion_tokens_per_call(self):
+        value_class = VALUE_FUNCTION_CLASSES[self.value_function_var.get()]
+        return value_class.completion_tokens * self.value_function_options().get("samples", 1)
+
+    def fixed_calls(self):
+        # calls the value function makes before any coalition
+        return VALUE_FUNCTION_CLASSES[self.value_function_var.get()].fixed_calls
+
+    def prepare_completion_tokens(self):
+        # the baseline / reference outputs, sampled like the coalitions
+        value_class = VALUE_FUNCTION_CLASSES[self.value_function_var.get()]
+        return value_class.prepare_completion_tokens * self.value_function_options().get("samples", 1)
+
+    def describe_estimate(self, estimate, prompt_count=1):
+        prefix = "up to " if ESTIMATOR_KINDS[self.estimator_var.get()] == SAMPLING else ""
+        return (
+            f"Estimator: {self.estimator_var.get()}\n"
+            f"Prompts: {prompt_count}\n"
+            f"Completion calls: {prefix}{estimate['calls']}\n"
+            f"Prompt tokens: ~{estimate['prompt_tokens']}\n"
+            f"Completion tokens: up to {estimate['completion_tokens']}\n"
+            f"Expected time: ~{estimate['seconds']:.0f} s\n"
+            f"(cached coalitions are free, so the real numbers can be lower)"
+        )
+
+    def _calculate_shap_values_thread(self, prompt, prompt_idx, call_budget=None):
         try:
             api_key = self.api_key.get().strip()
             max_tokens = None  # can set to something else like 15 compromising speed
-            model = "gpt-3.5-turbo"
+            model = "gpt-3.5-turbo"  # tokenizer, the value function picks the model it calls
+            estimator = self.estimator_var.get()
 
             self.content_frame.after(
                 0, lambda: self.update_status(prompt_idx, "Tokenizing...", "#FFA500")
@@ -206,49 +580,55 @@ class ShapValuesFrame(BaseFeatureFrame):
 
             enc = tiktoken.encoding_for_model(model)
             tokens_ids = enc.encode(prompt)
-            tokens = [
-                enc.decode_single_token_bytes(token).decode("utf-8", errors="ignore")
-                for token in tokens_ids
-            ]
 
-            if max_tokens and len(tokens) > max_tokens:  
+            if max_tokens and len(tokens_ids) > max_tokens:  
                 tokens_ids = tokens_ids[:max_tokens]
-                tokens = tokens[:max_tokens]
+
+            token_bytes = enc.decode_tokens_bytes(tokens_ids)  # once, coalition texts reuse them
+            tokens = [piece.decode("utf-8", errors="ignore") for piece in token_bytes]
 
             client = OpenAI(api_key=api_key)
+            value_function = VALUE_FUNCTION_CLASSES[self.value_function_var.get()](
+                client, **self.value_function_options()
+            )
 
-            baseline_key = "baseline_empty" # caching
-            baseline_output = self.coalition_cache.get(baseline_key)
-
-            if not baseline_output:
-                baseline_response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": ""},
-                    ],
-                    max_tokens=20,
-                    temperature=0,
-                )
-                baseline_output = baseline_response.choices[0].message.content
-                self.coalition_cache[baseline_key] = baseline_output
-
-            full_prompt_hash = hash(prompt)
-            full_key = f"full_{full_prompt_hash}"
-            full_output = self.coalition_cache.get(full_key)
-
-            if not full_output:
-                full_response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    max_tokens=20,
-                    temperature=0,
-                )
-                full_output = full_response.choices[0].message.content
-                self.coalition_cache[full_key] = full_output
+            cache = get_completion_cache()  # shared by every prompt and thread
+            persist = self.persist_cache_var.get()  # per run, batch threads share the cache
+            budget = CallBudget(call_budget)  # hard cap, cache hits don't count
+            call_seconds = []
+
+            def cached_call(cache_key, request):
+                # every api call of the value function goes through here
+                payload = cache.get(cache_key, MISSING, persist=persist)
+
+                if payload is MISSING:  # a cached None is still a hit
+                    budget.reserve()
+                    started = time.perf_counter()
+                    payload = request(client)
+                    call_seconds.append(time.perf_counter() - started)
+                    cache.put(cache_key, payload, persist=persist)
+
+                return payload
+
+            def evaluate_texts(texts):
+                # yields (index into texts, value) as soon as each value is known
+                if value_function.batched:  # every output first, then one scoring pass
+                    payloads = [None] * len(texts)
+                    for index, payload in run_concurrently(
+                        lambda text: value_function.fetch(cached_call, text),
+                        texts,
+                        self.concurrency_var.get(),
+                    ):
+                        payloads[index] = payload
+                    yield from enumerate(value_function.values(payloads))
+                else:
+                    yield from run_concurrently(
+                        lambda text: value_function.score(cached_call, text),
+                        texts,
+                        self.concurrency_var.get(),
+                    )
+
+            reference_outputs = value_function.prepare(cached_call, prompt)
 
             self.content_frame.after(
                 0,
@@ -256,213 +636,220 @@ class ShapValuesFrame(BaseFeatureFrame):
                     prompt_idx, "Analyzing tokens...", "#FFA500"
                 ),
             )
-            significant_token_indices = []
-            common_tokens = [ # will be removed but commend out if not needed
-                " ",
-                ".",
-                ",",
-                "!",
-                "?",
-                ":",
-                ";",
-                ")",
-                "(",
-                '"',
-                "'",
-                "-",
-                "_",
-                "the",
-                "a",
-                "an",
-                "and",
-                "of",
-                "to",
-                "in",
-                "is",
-                "that",
-                "for",
-            ]
+            significant_token_indices = significant_token_positions(tokens)
+            coalition_texts = CoalitionTexts(token_bytes, significant_token_indices)
 
-            for i, token in enumerate(tokens): # skip common tokens for less api calls
-                if token.lower() in common_tokens or not token.strip():
-                    continue
-                significant_token_indices.append(i)
+            total_tokens = len(significant_token_indices) # reduced sampling - target only 15-20 API calls total
+            calls_saved = 0
 
-            max_significant_tokens = None
-            if (
-                max_significant_tokens
-                and len(significant_token_indices) > max_significant_tokens
-            ):
-                significant_token_indices = significant_token_indices[
-                    :max_significant_tokens
-                ]  # 8  further reduced
+            # calls left for coalitions once the baseline and full outputs are in
+            fixed_calls = value_function.fixed_calls
+            available_calls = None if call_budget is None else max(call_budget - fixed_calls, 0)
 
-            total_tokens = len(significant_token_indices) # reduced sampling - target only 15-20 API calls total
-            max_samples = 20  # even fewer samples
-
-            # Determine optimal coalition sampling strategy
-            coalition_samples = {}  # Focus mainly on single-token and two-token effects
-
-            coalition_samples[0] = 1   #  check for empty coalition
-
-            coalition_samples[total_tokens - 1] = 1  # focus on single token removals (most informative)
-
-            remaining_samples = max_samples - 2 # add a few random small and medium-sized coalitions
-
-            if total_tokens > 2: # distribute remaining samples with focus on small coalitions
-                coalition_samples[1] = min(total_tokens, remaining_samples // 2) # single token
-                remaining_samples -= coalition_samples.get(1, 0)
-
-                if remaining_samples > 0 and total_tokens > 3:
-                    mid_sizes = list(range(2, total_tokens - 1))
-                    for size in mid_sizes:
-                        if remaining_samples > 0:
-                            coalition_samples[size] = 1
-                            remaining_samples -= 1
-
-            contribution_counts = {i: 0 for i in significant_token_indices} # tracking initialisation
-            contribution_sums = {i: 0.0 for i in significant_token_indices}
-
-            total_iterations = sum(coalition_samples.values()) # calc total iter
-            progress_step = 100.0 / total_iterations if total_iterations > 0 else 100
-            current_progress = 0
-
-            for size, num_samples in coalition_samples.items(): # coalition size
-                for _ in range(num_samples):
-                    if size == 0:
-                        coalition = []
-                    elif size == total_tokens:
-                        coalition = significant_token_indices.copy()
-                    else:
-                        coalition = random.sample(significant_token_indices, size)
-
-                    included_tokens = []
-                    for i, token_id in enumerate(tokens_ids):
-                        if i in coalition or i not in significant_token_indices:
-                            included_tokens.append(token_id)
-
-                    coalition_text = enc.decode(included_tokens)
-
-                    coalition_key = frozenset(coalition)
-                    coalition_hash = hash(coalition_key)
-                    cache_key = f"coalition_{coalition_hash}"
-
-                    if cache_key in self.coalition_cache:
-                        coalition_output = self.coalition_cache[cache_key]
-                    else:
-                        coalition_response = client.chat.completions.create(
-                            model=model,
-                            messages=[
-                                {
-                                    "role": "system",
-                                    "content": "You are a helpful assistant.",
-                                },
-                                {"role": "user", "content": coalition_text},
-                            ],
-                            max_tokens=20,
-                            temperature=0,
-                        )
-                        coalition_output = coalition_response.choices[0].message.content
-                        self.coalition_cache[cache_key] = coalition_output
-
-                    # calculate coalition effect using simple length comparison for speed
-                    # This is faster than TF-IDF for real quick results but less accurate
-                    coalition_effect = abs(
-                        len(baseline_output) - len(coalition_output)
-                    ) / max(len(baseline_output), len(coalition_output), 1)
-
-                    if size < total_tokens:
-                        missing_tokens = [
-                            t for t in significant_token_indices if t not in coalition
-                        ]
-
-                        for token_idx in missing_tokens:# for each token not in coalition, check its marginal contribution
-                            if contribution_counts.get(token_idx, 0) >= 3:
-                                continue
-
-                            new_coalition = coalition + [token_idx]
-                            new_coalition_key = frozenset(new_coalition)
-                            new_coalition_hash = hash(new_coalition_key)
-                            new_cache_key = f"coalition_{new_coalition_hash}"
-
-                            if new_cache_key in self.coalition_cache:
-                                new_coalition_output = self.coalition_cache[
-                                    new_cache_key
-                                ]
+            def evaluate_masks(masks):
+                # value of each coalition, True = significant token kept
+                nonlocal calls_saved
+                texts = PerturbationPlan()
+                for row, text in enumerate(coalition_texts.from_masks(masks)):
+                    texts.add(row, text)
+
+                effects = [None] * len(texts)
+                for index, effect in evaluate_texts(texts.texts):
+                    effects[index] = effect
+
+                calls_saved += texts.calls_saved
+                return np.array(texts.fan_out(effects))
+
+            def mask_errors(masks):
+                # standard error of each coalition value when the value function samples, else None
+                errors = [
+                    value_function.sample_error(text) for text in coalition_texts.from_masks(masks)
+                ]
+                return None if None in errors else np.array(errors)
+
+            estimates = {}  # token position -> estimated contribution
+            estimator_stats = {}
+
+            ci_widths = {}  # token position -> 95% confidence interval width
+
+            def on_batch(evaluated, budget):
+                self.content_frame.after(
+                    0, lambda p=100.0 * evaluated / budget: self.progress_var.set(min(p, 100))
+                )
+
+            if estimator == EXACT_ESTIMATOR:
+                if available_calls is not None and 2 ** total_tokens > available_calls:
+                    raise ValueError(
+                        f"Exact mode needs {2 ** total_tokens} coalition calls, the budget leaves {available_calls}"
+                    )
+                # every coalition text goes through the cache and the worker pool
+                # the only error left is the sampling noise of the values, if any
+                shapley_values, ci_width, estimator_stats = exact_shapley(
+                    evaluate_masks, total_tokens, on_batch=on_batch, error_fn=mask_errors
+                )
+                estimates = dict(zip(significant_token_indices, shapley_values))
+                if ci_width is not None:
+                    ci_widths = dict(zip(significant_token_indices, ci_width))
+
+            elif estimator == HIERARCHICAL_ESTIMATOR:
+                # sentences -> clauses -> words -> tokens, only significant groups are split
+                shapley_values, _, estimator_stats = hierarchical_shapley(
+                    evaluate_masks,
+                    tokens,
+                    significant_token_indices,
+                    max_evaluations=(
+                        MAX_EVALUATIONS if available_calls is None else available_calls
+                    ),
+                    on_batch=on_batch,
+                )
+                estimates = dict(zip(significant_token_indices, shapley_values))
+
+            elif estimator in SAMPLING_ESTIMATORS:
+                # their intervals come from the spread of the measured values, noise included
+                shapley_values, ci_width, estimator_stats = SAMPLING_ESTIMATORS[estimator](
+                    evaluate_masks,
+                    total_tokens,
+                    max_evaluations=(
+                        MAX_EVALUATIONS if available_calls is None else available_calls
+                    ),
+                    tolerance=self.tolerance_var.get(),
+                    on_batch=on_batch,
+                )
+                estimates = dict(zip(significant_token_indices, shapley_values))
+                if ci_width is not None:
+                    ci_widths = dict(zip(significant_token_indices, ci_width))
+
+            else:
+                # sample allocation and probes per token sized to fit the call budget
+                coalition_samples, probe_cap = heuristic_allocation(
+                    total_tokens, call_budget, fixed_calls
+                )
+
+                contribution_counts = {i: 0 for i in significant_token_indices} # tracking initialisation
+                contribution_sums = {i: 0.0 for i in significant_token_indices}
+                measured_counts = {i: 0 for i in significant_token_indices}  # pairs that came back
+                noise_sums = {i: 0.0 for i in significant_token_indices}  # sampled values only
+
+                # build the whole coalition plan up front, the sampling does not depend on any output
+                # coalitions are int bitmasks over the significant tokens, bit j = token j kept
+                planned_coalitions = []  # (coalition, [(token_idx, new_coalition), ...])
+                planned_texts = 0  # upper bound, duplicates are removed below
+                if total_tokens > 0:
+                    for size, num_samples in coalition_samples.items(): # coalition size
+                        for _ in range(num_samples):
+                            if available_calls is not None and planned_texts >= available_calls:
+                                break  # budget is a hard cap
+
+                            if size == 0:
+                                coalition = 0
+                            elif size == total_tokens:
+                                coalition = (1 << total_tokens) - 1
                             else:
-                                included_tokens = []
-                                for i, token_id in enumerate(tokens_ids):
-                                    if (
-                                        i in new_coalition
-                                        or i not in significant_token_indices
-                                    ):
-                                        included_tokens.append(token_id)
-
-                                new_coalition_text = enc.decode(included_tokens)
-
-                                new_coalition_response = client.chat.completions.create(
-                                    model=model,
-                                    messages=[
-                                        {
-                                            "role": "system",
-                                            "content": "You are a helpful assistant.",
-                                        },
-                                        {"role": "user", "content": new_coalition_text},
-                                    ],
-                                    max_tokens=20,
-                                    temperature=0,
-                                )
-                                new_coalition_output = new_coalition_response.choices[
-                                    0
-                                ].message.content
-                                self.coalition_cache[new_cache_key] = (
-                                    new_coalition_output
+                                coalition = sum(
+                                    1 << j for j in random.sample(range(total_tokens), size)
                                 )
 
-                            new_coalition_effect = abs(
-                                len(baseline_output) - len(new_coalition_output)
-                            ) / max(len(baseline_output), len(new_coalition_output), 1)
+                            marginal_probes = []
+                            if size < total_tokens:
+                                missing_tokens = [
+                                    j for j in range(total_tokens) if not coalition >> j & 1
+                                ]
 
+                                for j in missing_tokens:# for each token not in coalition, check its marginal contribution
+                                    token_idx = significant_token_indices[j]
+                                    if contribution_counts.get(token_idx, 0) >= probe_cap:
+                                        continue
+                                    if (
+                                        available_calls is not None
+                                        and planned_texts + len(marginal_probes) + 2 > available_calls
+                                    ):
+                                        break
+
+                                    marginal_probes.append((token_idx, coalition | 1 << j))
+                                    contribution_counts[token_idx] = (
+                                        contribution_counts.get(token_idx, 0) + 1
+                                    )
+
+                            planned_coalitions.append((coalition, marginal_probes))
+                            planned_texts += 1 + len(marginal_probes)
+
+                # different coalitions can decode to the same text (repeated tokens), request each text once
+                plan = PerturbationPlan()
+                for n, (coalition, marginal_probes) in enumerate(planned_coalitions):
+                    plan.add((n, None), coalition_texts.from_bitmask(coalition))
+                    for token_idx, new_coalition in marginal_probes:
+                        plan.add((n, token_idx), coalition_texts.from_bitmask(new_coalition))
+
+                # each marginal contribution needs two texts, it is added once the second one arrives
+                waiting_pairs = {}  # index into plan.texts -> [(coalition index, probe index, token_idx)]
+                for n, (coalition, marginal_probes) in enumerate(planned_coalitions):
+                    coalition_index = plan.index_of((n, None))
+                    for token_idx, _ in marginal_probes:
+                        probe_index = plan.index_of((n, token_idx))
+                        pair = (coalition_index, probe_index, token_idx)
+                        for index in {coalition_index, probe_index}:
+                            waiting_pairs.setdefault(index, []).append(pair)
+
+                progress_step = 100.0 / len(plan) if len(plan) > 0 else 100
+                current_progress = 0
+
+                coalition_effects = [None] * len(plan)
+                try:
+                    for index, effect in evaluate_texts(plan.texts):
+                        coalition_effects[index] = effect
+
+                        for coalition_index, probe_index, token_idx in waiting_pairs.pop(index, []):
+                            if (
+                                coalition_effects[coalition_index] is None
+                                or coalition_effects[probe_index] is None
+                            ):
+                                continue  # the other half is still in flight
                             marginal_contribution = (
-                                new_coalition_effect - coalition_effect
-                            )
-
-                            contribution_counts[token_idx] = (
-                                contribution_counts.get(token_idx, 0) + 1
+                                coalition_effects[probe_index] - coalition_effects[coalition_index]
                             )
                             contribution_sums[token_idx] = (
-                                contribution_sums.get(token_idx, 0)
-                                + marginal_contribution
+                                contribution_sums.get(token_idx, 0) + marginal_contribution
                             )
-
-                    current_progress += progress_step
-                    self.content_frame.after(
-                        0, lambda p=current_progress: self.progress_var.set(min(p, 100))
-                    )
+                            measured_counts[token_idx] += 1
+
+                            pair_errors = [
+                                value_function.sample_error(plan.texts[i])
+                                for i in (coalition_index, probe_index)
+                            ]
+                            if None not in pair_errors:
+                                noise_sums[token_idx] += sum(e ** 2 for e in pair_errors)
+
+                        current_progress += progress_step
+                        self.content_frame.after(
+                            0, lambda p=current_progress: self.progress_var.set(min(p, 100))
+                        )
+                except BudgetExhausted:  # the pairs that came back still count
+                    estimator_stats["budget_exhausted"] = True
+
+                for idx in significant_token_indices:
+                    count = measured_counts.get(idx, 0)
+                    if count > 0:
+                        estimates[idx] = contribution_sums.get(idx, 0) / count
+                        if value_function.samples > 1:
+                            # noise of the sampled values carried into the mean contribution
+                            ci_widths[idx] = 2 * CONFIDENCE_Z * math.sqrt(noise_sums[idx]) / count
+                calls_saved += plan.calls_saved
 
             token_data = []
-            for idx in significant_token_indices:
-                count = contribution_counts.get(idx, 0)
-                if count > 0:
-                    avg_contribution = contribution_sums.get(idx, 0) / count
-                    token_data.append(
-                        {
-                            "token": tokens[idx],
-                            "importance": float(avg_contribution),
-                            "position": idx,
-                        }
-                    )
-                else: # if cant analyse
-                    token_data.append(
-                        {
-                            "token": tokens[idx],
-                            "importance": 0.0,
-                            "position": idx,
-                        }
-                    )
+            for idx in significant_token_indices: # 0 if cant analyse
+                token_data.append(
+                    {
+                        "token": tokens[idx],
+                        "importance": float(estimates.get(idx, 0.0)),
+                        "position": idx,
+                    }
+                )
+                if idx in ci_widths:
+                    token_data[-1]["ci_width"] = float(ci_widths[idx])
 
+            significant_positions = set(significant_token_indices)
             for i, token in enumerate(tokens): # skipped tokens
-                if i not in significant_token_indices:
+                if i not in significant_positions:
                     token_data.append(
                         {
                             "token": token,
@@ -481,6 +868,8 @@ class ShapValuesFrame(BaseFeatureFrame):
                         td["importance"] = (td["importance"] - min_value) / (
                             max_value - min_value
                         )
+                        if "ci_width" in td:  # same scale as the normalised values
+                            td["ci_width"] /= max_value - min_value
 
             # sort by importance
             token_data.sort(key=lambda x: x["importance"], reverse=True)
@@ -488,14 +877,27 @@ class ShapValuesFrame(BaseFeatureFrame):
             report = {
                 "prompt": prompt,
                 "tokens": token_data,
+                "token_ids": list(tokens_ids),
                 "timestamp": datetime.now().isoformat(),
-                "model": model,
-                "baseline_output": baseline_output,
-                "full_output": full_output,
+                "model": value_function.model,
+                "value_function": value_function.label,
+                **reference_outputs,
+                "estimator": estimator,
+                "calls_saved": calls_saved,
+                "api_calls": budget.used,
+                "call_budget": call_budget,
+                **estimator_stats,
+                **value_function.stats,
                 "api_key": api_key,
             }
 
             self.result_data[prompt_idx] = report # store results
+            self.export_result(report)
+
+            if call_seconds:  # smooth the measured latency into the next estimate
+                self.seconds_per_call = (
+                    self.seconds_per_call + sum(call_seconds) / len(call_seconds)
+                ) / 2
 
             self.content_frame.after(
                 100,
@@ -504,12 +906,23 @@ class ShapValuesFrame(BaseFeatureFrame):
 
         except Exception as e:
             error_msg = str(e)
+            if isinstance(e, BudgetExhausted):  # ran out before a single coalition was scored
+                error_msg = f"{error_msg} before any token was scored, raise the call budget"
             print(f"Error in calculation thread: {error_msg}")  # print to terminal
             self.content_frame.after(
                 100,
                 lambda: self.update_ui_after_calculation(prompt_idx, False, error_msg),
             )
 
+    def export_result(self, report):
+        # machine readable copy in storage/results, a failed export doesn't fail the analysis
+        try:
+            from utils.results_exporter import get_results_exporter
+
+            get_results_exporter().add("shap", report)
+        except Exception as e:
+            print(f"Error exporting result: {str(e)}")
+
     def update_status(self, prompt_idx, message, color="#FFFFFF"):
         if prompt_idx in self.status_vars:
             self.status_vars[prompt_idx].set(message)
@@ -541,6 +954,8 @@ class ShapValuesFrame(BaseFeatureFrame):
         if calculate_button:
             calculate_button.config(state="normal")
 
+        self.record_batch_report(prompt_idx, success, error_msg)
+
         if success:
             self.update_status(prompt_idx, "Completed", "#4CAF50")  # Green for success
             self.progress_var.set(100)
@@ -688,34 +1103,137 @@ class ShapValuesFrame(BaseFeatureFrame):
         if not file_path:
             return  # user canceled
 
-        try:
-            from features.methods.shap_values.heatmap_generator import (
-                generate_shap_heatmap,
-            )
-
-            success = generate_shap_heatmap(result, file_path)
+        heatmap_button = self.status_vars.get(f"heatmap_button_{prompt_idx}")
+        if heatmap_button:  # one render per prompt at a time
+            heatmap_button.config(state="disabled")
+        self.update_status(prompt_idx, "Rendering heatmap...", "#FFA500")
 
+        def on_done(success, error_msg):
+            # back on the tk thread once the worker process has written the png
+            if heatmap_button:
+                heatmap_button.config(state="normal")
+            self.update_status(prompt_idx, "Completed", "#4CAF50")
             if success:
                 messagebox.showinfo(
                     "Heatmap Created",
                     f"SHAP heatmap visualization saved successfully to {file_path}",
                 )
             else:
-                messagebox.showerror(
-                    "Error", "Failed to create heatmap. Please try again."
+                messagebox.showerror("Error", f"Failed to create heatmap: {error_msg}")
+
+        try:
+            from utils.heatmap_renderer import get_heatmap_renderer
+
+            get_heatmap_renderer().render(
+                "shap", result, file_path, self.content_frame, on_done
+            )
+        except Exception as e:
+            on_done(False, str(e))
+
+    def batch_create_heatmaps(self):
+        # every finished prompt, rendered in parallel by the worker processes
+        results = sorted(self.result_data.items())
+        if not results:
+            messagebox.showwarning(
+                "No Data", "No analysis data available yet. Calculate some prompts first."
+            )
+            return
+
+        folder = filedialog.askdirectory(title="Choose a Folder for the Heatmaps")
+        if not folder:
+            return
+
+        remaining = [len(results)]
+        failed = []
+
+        def on_done(prompt_idx, success, error_msg):
+            remaining[0] -= 1
+            if not success:
+                failed.append(f"Prompt {prompt_idx}: {error_msg}")
+            if remaining[0] == 0:
+                message = f"{len(results) - len(failed)} of {len(results)} heatmaps saved to {folder}"
+                if failed:
+                    message += "\n\n" + "\n".join(failed[:5])
+                messagebox.showinfo("Heatmaps Created", message)
+
+        try:
+            from utils.heatmap_renderer import get_heatmap_renderer
+
+            renderer = get_heatmap_renderer()
+            for prompt_idx, result in results:
+                renderer.render(
+                    "shap",
+                    result,
+                    os.path.join(folder, f"prompt_{prompt_idx}_shap_heatmap.png"),
+                    self.content_frame,
+                    lambda success, error_msg, idx=prompt_idx: on_done(idx, success, error_msg),
                 )
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to create heatmap: {str(e)}")
+            messagebox.showerror("Error", f"Failed to create heatmaps: {str(e)}")
 
-    def batch_calculate_all(self):
-        confirm = messagebox.askyesno(
-            "Batch Process",
-            "This will calculate SHAP values for all prompts. This process can be time-consuming. Proceed?",
+    def start_batch_report(self, prompt_indices):
+        # optional, one report for the whole batch, written as each prompt finishes
+        self.close_batch_report()  # previous batch not finished, close its file as it is
+
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[
+                ("Text files", "*.txt"),
+                ("Zip of per prompt reports", "*.zip"),
+                ("All files", "*.*"),
+            ],
+            title="Save Batch Report (Cancel to skip)",
         )
+        if not file_path:
+            return
 
-        if not confirm:
+        try:
+            from utils.batch_report import BatchReportWriter
+            from features.methods.shap_values.report_writer import (
+                write_shap_report_to,
+            )
+
+            self.batch_report = BatchReportWriter(
+                file_path, write_shap_report_to, "SHAP TOKEN IMPORTANCE ANALYSIS"
+            )
+            self.batch_report_pending = set(prompt_indices)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to create batch report: {str(e)}")
+
+    def record_batch_report(self, prompt_idx, success, error_msg=None):
+        # main thread, called when a prompt of the batch finishes
+        if self.batch_report is None or prompt_idx not in self.batch_report_pending:
             return
 
+        self.batch_report_pending.discard(prompt_idx)
+        try:
+            if success:
+                self.batch_report.add(prompt_idx, self.result_data[prompt_idx])
+            else:
+                self.batch_report.add_failure(prompt_idx, error_msg or "Unknown error")
+
+            if not self.batch_report_pending:  # last prompt, write the summary
+                self.batch_report.close()
+                messagebox.showinfo(
+                    "Batch Report Complete",
+                    f"Batch report saved to {self.batch_report.file_path}",
+                )
+                self.batch_report = None
+        except Exception as e:
+            self.close_batch_report()
+            messagebox.showerror("Error", f"Failed to write batch report: {str(e)}")
+
+    def close_batch_report(self):
+        # releases the batch report file with whatever was written so far
+        if self.batch_report is None:
+            return
+        try:
+            self.batch_report.close()  # no-op if it was already closed
+        except Exception as e:
+            print(f"Error closing batch report: {str(e)}")
+        self.batch_report = None
+
+    def batch_calculate_all(self):
         api_key = self.api_key.get().strip()
         if not api_key:
             messagebox.showwarning(
@@ -724,9 +1242,76 @@ class ShapValuesFrame(BaseFeatureFrame):
             )
             return
 
-        for i, prompt in enumerate(self.prompts, 1):
-            if not prompt.strip():
-                continue
+        batch = [(i, prompt) for i, prompt in enumerate(self.prompts, 1) if prompt.strip()]
+        if not batch:
+            return
+
+        # the budget covers the whole batch, prompts that need fewer calls leave theirs to the others
+        total_budget = self.budget_var.get()
+        kind = ESTIMATOR_KINDS[self.estimator_var.get()]
+        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        demands = []
+        for _, prompt in batch:
+            tokens = [
+                enc.decode_single_token_bytes(token).decode("utf-8", errors="ignore")
+                for token in enc.encode(prompt)
+            ]
+            demands.append(
+                calls_wanted(kind, len(significant_token_positions(tokens)), self.fixed_calls())
+            )
+        min_prompt_calls = self.fixed_calls() + MIN_COALITION_CALLS
+        budgets = split_budget(total_budget, demands, min_prompt_calls)
+
+        # prompts that can't get the minimum are left out rather than run on a share of 0 or 1
+        left_out = [i for (i, _), call_budget in zip(batch, budgets) if call_budget == 0]
+        budgets = [call_budget for call_budget in budgets if call_budget > 0]
+        batch = [item for item in batch if item[0] not in left_out]
+        if not batch:
+            messagebox.showwarning(
+                "Budget Too Small",
+                f"A call budget of {total_budget} can't run any prompt, each one needs at least {min_prompt_calls} calls.",
+            )
+            return
+
+        estimates = []
+        skipped = 0
+        for (_, prompt), call_budget in zip(batch, budgets):
+            estimate = self.estimate_run(prompt, call_budget, show_warnings=False)
+            if estimate is None:
+                skipped += 1
+            else:
+                estimates.append(estimate)
+
+        total = {
+            key: sum(estimate[key] for estimate in estimates)
+            for key in ("calls", "prompt_tokens", "completion_tokens")
+        }
+        concurrency = max(self.concurrency_var.get(), 1)
+        total["seconds"] = math.ceil(total["calls"] / concurrency) * self.seconds_per_call
+
+        message = (
+            "This will calculate SHAP values for all prompts. This process can be time-consuming.\n\n"
+            f"Call budget: {total_budget} for the batch\n"
+            + self.describe_estimate(total, len(batch))
+        )
+        if left_out:
+            message += (
+                f"\n\nThe budget only covers {len(batch)} prompt(s) at {min_prompt_calls} calls each,"
+                f" prompt(s) {', '.join(map(str, left_out))} will be skipped."
+            )
+        if skipped:
+            message += f"\n\n{skipped} prompt(s) can't run in exact mode on their share of the budget and will fail."
+        confirm = messagebox.askyesno("Batch Process", message + "\n\nProceed?")
 
-            self.calculate_shap_values(prompt, i) # avoid freezing else you will have issues with threading
-            time.sleep(0.5)
+        if not confirm:
+            return
+
+        self.start_batch_report([i for i, _ in batch])
+
+        try:
+            for (i, prompt), call_budget in zip(batch, budgets):
+                self.calculate_shap_values(prompt, i, call_budget, confirm=False) # avoid freezing else you will have issues with threading
+                time.sleep(0.5)
+        except Exception:
+            self.close_batch_report()  # the remaining prompts never report back
+            raise
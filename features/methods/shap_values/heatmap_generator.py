@@ -1,7 +1,9 @@
 # heatmap generator for shap
+# builds its own Figure on the Agg canvas instead of going through pyplot, so it can run in the
+# renderer's worker processes (utils/heatmap_renderer.py), matplotlib is imported on first use
 # https://matplotlib.org/stable/index.html docs
+# https://matplotlib.org/stable/gallery/user_interfaces/canvasagg.html
 # https://seaborn.pydata.org/tutorial/color_palettes.html docs
-import matplotlib.pyplot as plt
 from datetime import datetime
 
 
@@ -20,8 +22,12 @@ def generate_shap_heatmap(result_data, output_path):
             if position is not None:
                 importance_by_position[position] = (importance, token_text)
 
-        plt.figure(figsize=(12, 8))
-        plt.subplot(2, 1, 1)
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=(12, 8))
+        FigureCanvasAgg(fig)  # no gui backend, renders straight to the png
+        ax = fig.add_subplot(2, 1, 1)
 
         sorted_positions = sorted(importance_by_position.keys())
         display_tokens = []
@@ -41,16 +47,17 @@ def generate_shap_heatmap(result_data, output_path):
             display_tokens.append(display_token)
             importance_values.append(importance)
 
-        cmap = plt.cm.Blues  # colour
+        cmap = "Blues"  # colour
 
-        plt.imshow([importance_values], cmap=cmap, aspect="auto")
-        plt.colorbar(label="SHAP Value")
-        plt.title("Token SHAP Values Heatmap")
-        plt.yticks([])
+        image = ax.imshow([importance_values], cmap=cmap, aspect="auto")
+        fig.colorbar(image, ax=ax, label="SHAP Value")
+        ax.set_title("Token SHAP Values Heatmap")
+        ax.set_yticks([])
 
-        plt.xticks(range(len(display_tokens)), display_tokens, rotation=45, ha="right")
+        ax.set_xticks(range(len(display_tokens)))
+        ax.set_xticklabels(display_tokens, rotation=45, ha="right")
 
-        plt.subplot(2, 1, 2)
+        ax = fig.add_subplot(2, 1, 2)
 
         sorted_token_data = sorted(  # sort tokensby imp
             tokens_data, key=lambda x: x.get("importance", 0), reverse=True
@@ -73,14 +80,15 @@ def generate_shap_heatmap(result_data, output_path):
             bar_tokens.append(token_text)
             bar_values.append(token_info.get("importance", 0))
 
-        bars = plt.bar(range(len(bar_tokens)), bar_values, color="skyblue")
-        plt.xticks(range(len(bar_tokens)), bar_tokens, rotation=45, ha="right")
-        plt.ylabel("SHAP Value")
-        plt.title("Top Tokens by SHAP Value")
+        bars = ax.bar(range(len(bar_tokens)), bar_values, color="skyblue")
+        ax.set_xticks(range(len(bar_tokens)))
+        ax.set_xticklabels(bar_tokens, rotation=45, ha="right")
+        ax.set_ylabel("SHAP Value")
+        ax.set_title("Top Tokens by SHAP Value")
 
         for bar in bars:
             height = bar.get_height()
-            plt.text(
+            ax.text(
                 bar.get_x() + bar.get_width() / 2.0,
                 height + 0.01,
                 f"{height:.2f}",
@@ -89,7 +97,7 @@ def generate_shap_heatmap(result_data, output_path):
                 fontsize=9,
             )
 
-        plt.figtext(  # metadata
+        fig.text(  # metadata
             0.5,
             0.01,
             f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | Model: {result_data.get('model', 'Unknown')}",
@@ -98,10 +106,9 @@ def generate_shap_heatmap(result_data, output_path):
             bbox=dict(facecolor="white", alpha=0.5),
         )
 
-        plt.tight_layout(rect=[0, 0.03, 1, 1])
+        fig.tight_layout(rect=[0, 0.03, 1, 1])
 
-        plt.savefig(output_path, dpi=300, bbox_inches="tight")
-        plt.close()
+        fig.savefig(output_path, dpi=300, bbox_inches="tight")
 
         return True
 
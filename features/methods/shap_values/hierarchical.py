@@ -0,0 +1,141 @@
+# hierarchical (owen style) SHAP for long prompts
+# the prompt is split into sentences, then clauses, words and tokens. Shapley values are computed
+# between the groups of one node with everything outside the node kept, shifted so the children
+# add up to what the node got from its parent, and only groups with a significant share are split
+# further, largest first, until the call budget runs out. Groups that are never split share
+# their value equally between their tokens
+# https://en.wikipedia.org/wiki/Owen_value
+# https://shap.readthedocs.io/en/latest/generated/shap.PartitionExplainer.html
+
+import heapq
+
+import numpy as np
+
+from features.methods.shap_values.budget_planner import BudgetExhausted
+from features.methods.shap_values.estimators import (
+    MAX_EVALUATIONS,
+    exact_shapley,
+    kernel_shap,
+)
+from utils.token_spans import (
+    child_spans,
+    clause_spans,
+    sentence_spans,
+    single_token_spans,
+    word_spans,
+)
+
+HIERARCHY_LEVELS = [sentence_spans, clause_spans, word_spans, single_token_spans]
+EXACT_GROUP_LIMIT = 8  # nodes with up to 8 groups are solved exactly (256 coalitions)
+SAMPLED_NODE_EVALUATIONS = 128  # most a node is sampled with when exact is too big or too expensive
+DEFAULT_THRESHOLD = 0.05  # fraction of the largest group value a group needs to be split
+
+
+def hierarchical_shapley(
+    value_fn,
+    tokens,
+    player_positions,
+    max_evaluations=MAX_EVALUATIONS,
+    threshold=DEFAULT_THRESHOLD,
+    levels=HIERARCHY_LEVELS,
+    rng=None,
+    on_batch=None,
+):
+    # value_fn works on player masks like the other estimators, player j is the token at
+    # player_positions[j], tokens are the strings used to find the group boundaries
+    # returns (value per player, None, run stats)
+    n_players = len(player_positions)
+    phi = np.zeros(n_players)
+    stats = {"evaluations": 0, "groups_refined": 0, "converged": False}
+    if n_players == 0:
+        return phi, None, stats
+
+    player_of = {position: j for j, position in enumerate(player_positions)}
+
+    def players_in(span):
+        return [player_of[i] for i in range(span[0], span[1]) if i in player_of]
+
+    def counted_value(masks):
+        values = value_fn(masks)  # only counted once they came back
+        stats["evaluations"] += len(masks)
+        if on_batch:
+            on_batch(min(stats["evaluations"], max_evaluations), max_evaluations)
+        return values
+
+    v_empty, v_full = np.asarray(
+        counted_value(np.array([np.zeros(n_players, bool), np.ones(n_players, bool)])),
+        dtype=np.float64,
+    )
+
+    def share_equally(members, value):
+        phi[members] = value / len(members)
+
+    # (-|value|, tie breaker, span, level, value), the biggest groups are split first
+    queue = [(-abs(v_full - v_empty), 0, (0, len(tokens)), 0, v_full - v_empty)]
+    pushed = 1
+    scale = None
+    budget_hit = False
+
+    while queue:
+        _, _, span, level, value = heapq.heappop(queue)
+        members = players_in(span)
+        if len(members) == 1:
+            phi[members[0]] = value
+            continue
+
+        children, child_level = child_spans(tokens, span, level, levels)
+        groups = [(child, players_in(child)) for child in children]
+        groups = [(child, group) for child, group in groups if group]  # drop skipped-token-only groups
+
+        if len(groups) == 1:  # nothing to split at this level, free to go one deeper
+            heapq.heappush(queue, (-abs(value), pushed, groups[0][0], child_level + 1, value))
+            pushed += 1
+            continue
+
+        remaining = max_evaluations - stats["evaluations"]
+        exact = len(groups) <= EXACT_GROUP_LIMIT and 2 ** len(groups) <= remaining
+        cost = 2 ** len(groups) if exact else min(SAMPLED_NODE_EVALUATIONS, remaining)
+        if not exact and cost < 2 * len(groups) + 2:  # too few calls left to say anything
+            budget_hit = True
+            share_equally(members, value)
+            continue
+
+        def group_value(group_masks):
+            # tokens outside this node stay in the prompt
+            masks = np.ones((len(group_masks), n_players), dtype=bool)
+            for g, (_, group) in enumerate(groups):
+                masks[:, group] = group_masks[:, [g]]
+            return counted_value(masks)
+
+        try:
+            if exact:
+                group_phi, _, _ = exact_shapley(group_value, len(groups))
+            else:
+                group_phi, _, node_stats = kernel_shap(
+                    group_value, len(groups), max_evaluations=cost, rng=rng
+                )
+                if node_stats.get("budget_exhausted"):  # sampled until the budget ran out
+                    budget_hit = True
+                    stats["budget_exhausted"] = True
+        except BudgetExhausted:  # the groups split so far keep their values
+            budget_hit = True
+            stats["budget_exhausted"] = True
+            share_equally(members, value)
+            continue
+
+        group_phi = group_phi + (value - group_phi.sum()) / len(groups)  # add up to the parent
+        stats["groups_refined"] += 1
+        if scale is None:
+            scale = max(np.abs(group_phi).max(), 1e-12)  # from the top level split
+
+        for (child, group), child_value in zip(groups, group_phi):
+            if len(group) > 1 and abs(child_value) >= threshold * scale:
+                heapq.heappush(
+                    queue, (-abs(child_value), pushed, child, child_level + 1, child_value)
+                )
+                pushed += 1
+            else:
+                share_equally(group, child_value)
+
+    stats["converged"] = not budget_hit  # every significant group was split down to tokens
+    return phi, None, stats
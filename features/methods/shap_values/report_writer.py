@@ -2,55 +2,135 @@
 def write_shap_importance_report(file_path, result_data):
     try:
         with open(file_path, "w", encoding="utf-8") as f:
-            # header
-            f.write("SHAP TOKEN IMPORTANCE ANALYSIS\n")
-            f.write("=" * 50 + "\n\n")
+            write_shap_report_to(f, result_data)
+        return True
+    except Exception as e:  # error handling
+        print(f"Error writing SHAP report: {str(e)}")
+        return False
 
-            f.write(f"Analysis Date: {result_data.get('timestamp', 'Unknown')}\n")
-            f.write(f"Model: {result_data.get('model', 'Unknown')}\n\n")
 
-            f.write("ORIGINAL PROMPT:\n")
-            f.write("-" * 50 + "\n")
-            original_prompt = result_data.get("prompt", "Unknown")
-            f.write(f"{original_prompt}\n\n")
+def write_shap_report_to(f, result_data):
+    # writes into an open text file, also used for the batch reports
+    # header
+    f.write("SHAP TOKEN IMPORTANCE ANALYSIS\n")
+    f.write("=" * 50 + "\n\n")
 
-            baseline_output = result_data.get("baseline_output", "")
+    f.write(f"Analysis Date: {result_data.get('timestamp', 'Unknown')}\n")
+    f.write(f"Model: {result_data.get('model', 'Unknown')}\n")
+    if "value_function" in result_data:
+        f.write(f"Coalition Value: {result_data['value_function']}\n")
+    if "embedding_model" in result_data:
+        f.write(
+            f"Embedding Model: {result_data['embedding_model']}"
+            f" ({result_data.get('embedding_requests', 0)} requests,"
+            f" {result_data.get('embedding_cache_hits', 0)} cached)\n"
+        )
+    if "samples_per_coalition" in result_data:
+        f.write(
+            f"Samples per Coalition: {result_data['samples_per_coalition']}"
+            f" (temperature {result_data['sampling_temperature']})\n"
+        )
+        if "mean_sample_spread" in result_data:
+            f.write(
+                f"Sample Spread per Coalition: mean {result_data['mean_sample_spread']:.4f},"
+                f" max {result_data['max_sample_spread']:.4f}\n"
+            )
+    if "streams_stopped_early" in result_data:
+        f.write(
+            f"Streams Stopped Early: {result_data['streams_stopped_early']}"
+            f" (saved up to {result_data['stream_tokens_saved']} output tokens,"
+            f" ~{result_data['stream_seconds_saved']:.1f} s)\n"
+        )
+    if "estimator" in result_data:
+        f.write(f"Estimator: {result_data['estimator']}\n")
+    if "groups_refined" in result_data:
+        f.write(f"Groups Split: {result_data['groups_refined']}\n")
+    if "permutations" in result_data:
+        f.write(f"Permutations Sampled: {result_data['permutations']}\n")
+    if "evaluations" in result_data:
+        if result_data.get("exact"):
+            stop_reason = "every coalition"
+        elif result_data.get("converged"):
+            stop_reason = "converged"
+        elif result_data.get("budget_exhausted"):
+            stop_reason = "call budget used up, partial result"
+        else:
+            stop_reason = "budget reached"
+        f.write(
+            f"Coalitions Evaluated: {result_data['evaluations']} ({stop_reason})\n"
+        )
+    if "api_calls" in result_data:
+        budget_note = (
+            f" (budget {result_data['call_budget']})"
+            if result_data.get("call_budget")
+            else ""
+        )
+        f.write(f"API Calls: {result_data['api_calls']}{budget_note}\n")
+    if "calls_saved" in result_data:
+        f.write(
+            f"Duplicate Coalitions Skipped: {result_data['calls_saved']}\n"
+        )
+    f.write("\n")
 
-            f.write("BASELINE MODEL OUTPUT (empty prompt):\n")
-            f.write("-" * 50 + "\n")
-            f.write(f"{baseline_output}\n\n")
+    f.write("ORIGINAL PROMPT:\n")
+    f.write("-" * 50 + "\n")
+    original_prompt = result_data.get("prompt", "Unknown")
+    f.write(f"{original_prompt}\n\n")
 
-            f.write("TOKEN SHAP VALUES:\n")
-            f.write("-" * 50 + "\n")
-            f.write(f"{'TOKEN':<20} {'SHAP VALUE':<15} {'POSITION':<10}\n")
-            f.write("-" * 50 + "\n")
+    if "baseline_output" in result_data:  # only the length value function has one
+        f.write("BASELINE MODEL OUTPUT (empty prompt):\n")
+        f.write("-" * 50 + "\n")
+        f.write(f"{result_data['baseline_output']}\n\n")
 
-            # Get token data
-            tokens = result_data.get("tokens", [])
+    if "full_output" in result_data:
+        f.write("REFERENCE MODEL OUTPUT (full prompt):\n")
+        f.write("-" * 50 + "\n")
+        f.write(f"{result_data['full_output']}\n")
+        if "reference_token" in result_data:
+            f.write(f"Scored token: {result_data['reference_token']!r}\n")
+        f.write("\n")
 
-            sorted_tokens = sorted(  # Sort tokens by importance
-                tokens, key=lambda x: x.get("importance", 0), reverse=True
-            )
+    f.write("TOKEN SHAP VALUES:\n")
+    f.write("-" * 50 + "\n")
+    has_ci = any("ci_width" in token_data for token_data in result_data.get("tokens", []))
+    if has_ci:
+        f.write(
+            f"{'TOKEN':<20} {'SHAP VALUE':<15} {'POSITION':<10} {'95% CI WIDTH':<12}\n"
+        )
+        f.write("-" * 62 + "\n")
+    else:
+        f.write(f"{'TOKEN':<20} {'SHAP VALUE':<15} {'POSITION':<10}\n")
+        f.write("-" * 50 + "\n")
 
-            # write each token's data and display of special characters
-            for token_data in sorted_tokens:
-                token = token_data.get("token", "")
-                if token == "\n":
-                    token_display = "\\n"
-                elif token == "\t":
-                    token_display = "\\t"
-                elif token.isspace():
-                    token_display = "[space]"
-                else:
-                    token_display = token
+    # Get token data
+    tokens = result_data.get("tokens", [])
 
-                token_display = token_display[:20]  # limit
+    sorted_tokens = sorted(  # Sort tokens by importance
+        tokens, key=lambda x: x.get("importance", 0), reverse=True
+    )
 
-                importance = token_data.get("importance", 0)
-                position = token_data.get("position", 0)
+    # write each token's data and display of special characters
+    for token_data in sorted_tokens:
+        token = token_data.get("token", "")
+        if token == "\n":
+            token_display = "\\n"
+        elif token == "\t":
+            token_display = "\\t"
+        elif token.isspace():
+            token_display = "[space]"
+        else:
+            token_display = token
 
-                f.write(f"{token_display:<20} {importance:<15.4f} {position:<10}\n")
-        return True
-    except Exception as e:  # error handling
-        print(f"Error writing SHAP report: {str(e)}")
-        return False
+        token_display = token_display[:20]  # limit
+
+        importance = token_data.get("importance", 0)
+        position = token_data.get("position", 0)
+
+        if has_ci:
+            ci_width = token_data.get("ci_width")
+            ci_display = f"{ci_width:.4f}" if ci_width is not None else "-"
+            f.write(
+                f"{token_display:<20} {importance:<15.4f} {position:<10} {ci_display:<12}\n"
+            )
+        else:
+            f.write(f"{token_display:<20} {importance:<15.4f} {position:<10}\n")
@@ -0,0 +1,442 @@
+# value_functions.py
+# pluggable coalition value functions for the SHAP frame
+# cached_call(key, request) is passed in by the frame, it returns the cached payload for key or
+# runs request(client) once (counted against the call budget) and caches what it returns,
+# so every payload here has to be json serialisable
+# LengthValue -> the original heuristic, 20 generated tokens compared by length with the baseline,
+#                optionally n sampled answers per call averaged, the spread of each coalition's
+#                samples is kept by coalition text and gives the standard error of its value
+# LogprobValue -> log probability of the reference answer's first token, max_tokens=1
+# EchoLogprobValue -> mean log probability of the whole reference answer, echo on the completions api
+# EmbeddingValue -> cosine similarity of the coalition's output to the full prompt's output,
+#                   outputs are collected first and embedded in a few batched, cached requests
+# StreamingPrefixValue -> how much of the full prompt's answer the coalition reproduces, streamed
+#                         and cancelled as soon as the answer diverges or reaches the reference length
+# https://platform.openai.com/docs/api-reference/chat/create#chat-create-logprobs
+# https://platform.openai.com/docs/api-reference/completions/create#completions-create-echo
+# https://platform.openai.com/docs/api-reference/chat/streaming
+# https://platform.openai.com/docs/api-reference/chat/create#chat-create-n
+
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+from features.methods.cosine_similarity.scoring import cosine_similarities
+from utils.completion_cache import make_completion_key
+from utils.perturbation_planner import PerturbationPlan
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+COMPLETION_MAX_TOKENS = 20
+COMPLETION_TEMPERATURE = 0
+TOP_LOGPROBS = 20  # most the chat api returns per position
+MISSING_TOKEN_PENALTY = 1.0  # below the lowest returned logprob when the target isn't in the top list
+EMPTY_LOGPROB = -30.0  # floor when a completion comes back empty, with no candidates at all
+MAX_SAMPLES = 8  # answers per request with the n parameter
+DEFAULT_SAMPLING_TEMPERATURE = 1.0  # samples at temperature 0 would all be the same answer
+
+
+def first_top_logprobs(choice):
+    # candidates at the first output position, {} for an empty or filtered completion
+    content = choice.logprobs.content if choice.logprobs else None
+    if not content:
+        return {}
+    return {candidate.token: candidate.logprob for candidate in content[0].top_logprobs}
+
+
+def generate(cached_call, model, text, max_tokens=COMPLETION_MAX_TOKENS):
+    # greedy chat completion, same cache key as before value functions existed
+    def request(client):
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=max_tokens,
+            temperature=COMPLETION_TEMPERATURE,
+        )
+        return response.choices[0].message.content or ""  # None for a filtered answer
+
+    key = make_completion_key(model, SYSTEM_PROMPT, max_tokens, COMPLETION_TEMPERATURE, text)
+    return cached_call(key, request)
+
+
+def generate_samples(cached_call, model, text, samples, temperature, max_tokens=COMPLETION_MAX_TOKENS):
+    # n sampled answers from one request, the prompt is only sent (and billed) once
+    if samples == 1 and temperature == COMPLETION_TEMPERATURE:
+        return [generate(cached_call, model, text, max_tokens)]
+
+    def request(client):
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            n=samples,
+        )
+        choices = sorted(response.choices, key=lambda choice: choice.index)
+        return [choice.message.content or "" for choice in choices]
+
+    key = make_completion_key(model, SYSTEM_PROMPT, max_tokens, temperature, text, n=samples)
+    return cached_call(key, request)
+
+
+class ValueFunction:
+    label = "base"
+    model = "gpt-3.5-turbo"
+    completion_tokens = COMPLETION_MAX_TOKENS  # generated per coalition call, for the estimate
+    prepare_completion_tokens = COMPLETION_MAX_TOKENS  # generated by prepare(), for the estimate
+    fixed_calls = 1  # completion calls prepare() makes, charged to the budget before the coalitions
+    batched = False  # True = fetch() every coalition first, then values() on all of them at once
+    supports_samples = False  # True = uses the samples and temperature options
+
+    def __init__(self, client=None, samples=1, temperature=COMPLETION_TEMPERATURE):
+        self.client = client  # for requests that don't go through cached_call
+        self.samples = samples  # answers per coalition, all from one request
+        self.temperature = temperature
+        self.stats = {}  # extra fields for the report
+
+    def prepare(self, cached_call, prompt):
+        # one off calls before the coalitions, returns the fields shown in the report
+        raise NotImplementedError
+
+    def score(self, cached_call, text):
+        # value of the coalition whose prompt is text
+        raise NotImplementedError
+
+    def sample_error(self, text):
+        # standard error of score(text) from sampling, None = the value isn't sampled
+        return None
+
+    def fetch(self, cached_call, text):
+        # batched value functions only, the per coalition api call
+        raise NotImplementedError
+
+    def values(self, payloads):
+        # batched value functions only, one value per fetched payload
+        raise NotImplementedError
+
+
+class LengthValue(ValueFunction):
+    label = "Output length (20 tokens)"
+    supports_samples = True
+    prepare_completion_tokens = 2 * COMPLETION_MAX_TOKENS  # baseline and full prompt
+    fixed_calls = 2
+
+    def __init__(self, client=None, samples=1, temperature=COMPLETION_TEMPERATURE):
+        super().__init__(client, samples, temperature)
+        self.spreads = {}  # coalition text -> standard deviation of its sample effects
+        self._spreads_lock = threading.Lock()  # score() runs on the worker threads
+
+    def prepare(self, cached_call, prompt):
+        baseline_outputs = generate_samples(
+            cached_call, self.model, "", self.samples, self.temperature
+        )  # empty prompt
+        self.baseline_output = baseline_outputs[0]
+        self.baseline_length = np.mean([len(output) for output in baseline_outputs])
+        full_output = generate_samples(
+            cached_call, self.model, prompt, self.samples, self.temperature
+        )[0]
+        if self.samples > 1:
+            self.stats.update(
+                samples_per_coalition=self.samples, sampling_temperature=self.temperature
+            )
+        return {"baseline_output": self.baseline_output, "full_output": full_output}
+
+    def score(self, cached_call, text):
+        coalition_outputs = generate_samples(
+            cached_call, self.model, text, self.samples, self.temperature
+        )
+        # calculate coalition effect using simple length comparison for speed
+        # This is faster than TF-IDF for real quick results but less accurate
+        effects = [
+            abs(self.baseline_length - len(output))
+            / max(self.baseline_length, len(output), 1)
+            for output in coalition_outputs
+        ]
+        if self.samples > 1:
+            with self._spreads_lock:  # keyed, a repeated or cached coalition isn't counted twice
+                self.spreads[text] = float(np.std(effects, ddof=1))
+                spreads = list(self.spreads.values())
+                self.stats["mean_sample_spread"] = float(np.mean(spreads))
+                self.stats["max_sample_spread"] = max(spreads)
+        return float(np.mean(effects))
+
+    def sample_error(self, text):
+        if self.samples <= 1 or text not in self.spreads:
+            return None
+        return self.spreads[text] / np.sqrt(self.samples)
+
+
+class LogprobValue(ValueFunction):
+    label = "Reference logprob (1 token)"
+    completion_tokens = 1
+
+    def _reference(self, cached_call, prompt):
+        # the full prompt's answer and its first token's top logprobs come from the same request
+        def request(client):
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                max_tokens=COMPLETION_MAX_TOKENS,
+                temperature=COMPLETION_TEMPERATURE,
+                logprobs=True,
+                top_logprobs=TOP_LOGPROBS,
+            )
+            choice = response.choices[0]
+            return {
+                "answer": choice.message.content or "",
+                "top_logprobs": first_top_logprobs(choice),
+            }
+
+        key = make_completion_key(
+            self.model,
+            SYSTEM_PROMPT,
+            COMPLETION_MAX_TOKENS,
+            COMPLETION_TEMPERATURE,
+            prompt,
+            logprobs=True,
+            top_logprobs=TOP_LOGPROBS,
+        )
+        return cached_call(key, request)
+
+    def _top_logprobs(self, cached_call, text):
+        def request(client):
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": text},
+                ],
+                max_tokens=1,
+                temperature=COMPLETION_TEMPERATURE,
+                logprobs=True,
+                top_logprobs=TOP_LOGPROBS,
+            )
+            return first_top_logprobs(response.choices[0])
+
+        key = make_completion_key(
+            self.model,
+            SYSTEM_PROMPT,
+            1,
+            COMPLETION_TEMPERATURE,
+            text,
+            logprobs=True,
+            top_logprobs=TOP_LOGPROBS,
+        )
+        return cached_call(key, request)
+
+    def prepare(self, cached_call, prompt):
+        reference = self._reference(cached_call, prompt)  # one call, not a generate() as well
+        full_logprobs = reference["top_logprobs"]
+        if not full_logprobs:
+            raise ValueError("The model returned no logprobs for the full prompt, nothing to score against")
+        self.target_token = max(full_logprobs, key=full_logprobs.get)  # greedy first token
+        return {
+            "full_output": reference["answer"],
+            "reference_token": self.target_token,
+        }
+
+    def score(self, cached_call, text):
+        top_logprobs = self._top_logprobs(cached_call, text)
+        if not top_logprobs:
+            return EMPTY_LOGPROB
+        if self.target_token in top_logprobs:
+            return top_logprobs[self.target_token]
+        # not in the top list, so it is at most the smallest logprob that was returned
+        return min(top_logprobs.values(), default=0.0) - MISSING_TOKEN_PENALTY
+
+
+class EchoLogprobValue(ValueFunction):
+    # needs a completions model that still supports echo with logprobs
+    label = "Reference logprob (echo, davinci-002)"
+    model = "davinci-002"
+    completion_tokens = 0
+    separator = "\n\n"
+
+    def prepare(self, cached_call, prompt):
+        def request(client):
+            response = client.completions.create(
+                model=self.model,
+                prompt=prompt + self.separator,
+                max_tokens=COMPLETION_MAX_TOKENS,
+                temperature=COMPLETION_TEMPERATURE,
+            )
+            return response.choices[0].text
+
+        key = make_completion_key(
+            self.model, "", COMPLETION_MAX_TOKENS, COMPLETION_TEMPERATURE, prompt + self.separator
+        )
+        self.reference_answer = cached_call(key, request)
+        return {"full_output": self.reference_answer}
+
+    def score(self, cached_call, text):
+        prefix = text + self.separator
+        scored_text = prefix + self.reference_answer
+
+        def request(client):
+            response = client.completions.create(
+                model=self.model,
+                prompt=scored_text,
+                max_tokens=0,
+                echo=True,
+                logprobs=0,
+            )
+            logprobs = response.choices[0].logprobs
+            answer = [
+                logprob
+                for logprob, offset in zip(logprobs.token_logprobs, logprobs.text_offset)
+                if offset >= len(prefix) and logprob is not None
+            ]
+            return sum(answer) / len(answer) if answer else 0.0
+
+        key = make_completion_key(self.model, "", 0, COMPLETION_TEMPERATURE, scored_text, echo=True)
+        return cached_call(key, request)
+
+
+class EmbeddingValue(ValueFunction):
+    label = "Output embedding similarity"
+    embedding_model = "text-embedding-3-small"
+    batched = True
+
+    def prepare(self, cached_call, prompt):
+        full_output = generate(cached_call, self.model, prompt)
+        self.full_embedding = self._embed([full_output])[0]
+        return {"full_output": full_output, "embedding_model": self.embedding_model}
+
+    def fetch(self, cached_call, text):
+        return generate(cached_call, self.model, text)  # same cache entries as LengthValue
+
+    def values(self, payloads):
+        outputs = PerturbationPlan()  # many coalitions give the same short answer
+        for n, output in enumerate(payloads):
+            outputs.add(n, output)
+
+        similarities = np.zeros(len(outputs))  # an empty answer shares nothing with the reference
+        requested = [n for n, output in enumerate(outputs.texts) if output.strip()]
+        if requested and self.full_embedding is not None:
+            embeddings = self._embed([outputs.texts[n] for n in requested])
+            similarities[requested] = cosine_similarities(self.full_embedding, embeddings)
+
+        return np.array(outputs.fan_out(similarities))
+
+    def _embed(self, texts):
+        from utils.embedding_cache import get_embedding_cache
+        from utils.embeddings import embed_texts
+
+        if not any(text.strip() for text in texts):
+            return [None] * len(texts)
+
+        embedding_stats = {}
+        embeddings = embed_texts(
+            self.client,
+            texts,
+            self.embedding_model,
+            cache=get_embedding_cache(),  # persistent, shared with the cosine method
+            stats=embedding_stats,
+        )
+        self.stats["embedding_requests"] = (
+            self.stats.get("embedding_requests", 0) + embedding_stats.get("api_requests", 0)
+        )
+        self.stats["embedding_cache_hits"] = (
+            self.stats.get("embedding_cache_hits", 0) + embedding_stats.get("cache_hits", 0)
+        )
+        return embeddings
+
+
+class StreamingPrefixValue(ValueFunction):
+    label = "Reference prefix agreement (streaming)"
+
+    def __init__(self, client=None):
+        super().__init__(client)
+        self._stats_lock = threading.Lock()  # score() runs on the worker threads
+        self.stats = {
+            "streams_stopped_early": 0,
+            "stream_tokens_saved": 0,
+            "stream_seconds_saved": 0.0,
+        }
+
+    def prepare(self, cached_call, prompt):
+        self.reference = generate(cached_call, self.model, prompt)
+        return {"full_output": self.reference}
+
+    def score(self, cached_call, text):
+        reference = self.reference
+
+        def request(client):
+            stream = client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": text},
+                ],
+                max_tokens=COMPLETION_MAX_TOKENS,
+                temperature=COMPLETION_TEMPERATURE,
+                stream=True,
+            )
+            output = ""
+            tokens = 0
+            first_token_at = None  # the wait for the first token isn't generation time
+            diverged = False
+            try:
+                for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    output += chunk.choices[0].delta.content
+                    tokens += 1  # one content delta per generated token
+                    if not reference.startswith(output):
+                        diverged = True  # more tokens can't change the value
+                        break
+                    if len(output) >= len(reference):
+                        break  # matched all of it, the model stops here anyway, nothing saved
+            finally:
+                stream.close()  # cancels the rest of the generation
+
+            if diverged and tokens < COMPLETION_MAX_TOKENS:
+                # the model could have gone on up to max_tokens, so this is an upper bound
+                tokens_saved = COMPLETION_MAX_TOKENS - tokens
+                seconds_per_token = (
+                    (time.perf_counter() - first_token_at) / (tokens - 1) if tokens > 1 else 0.0
+                )  # one token gives no rate, counted as 0 s
+                with self._stats_lock:
+                    self.stats["streams_stopped_early"] += 1
+                    self.stats["stream_tokens_saved"] += tokens_saved
+                    self.stats["stream_seconds_saved"] += tokens_saved * seconds_per_token
+            return output
+
+        # the stopping point depends on the reference, so it is part of the key
+        key = make_completion_key(
+            self.model,
+            SYSTEM_PROMPT,
+            COMPLETION_MAX_TOKENS,
+            COMPLETION_TEMPERATURE,
+            text,
+            stream_until=hashlib.sha256(reference.encode("utf-8")).hexdigest(),
+        )
+        output = cached_call(key, request)
+
+        agreement = 0
+        for produced, expected in zip(output, reference):
+            if produced != expected:
+                break
+            agreement += 1
+        return agreement / max(len(reference), 1)
+
+
+VALUE_FUNCTIONS = [
+    LengthValue,
+    LogprobValue,
+    EchoLogprobValue,
+    EmbeddingValue,
+    StreamingPrefixValue,
+]
@@ -0,0 +1,136 @@
+# batch_report.py
+# one report for a whole batch of prompts, written as each analysis finishes
+# .zip = one report file per prompt plus summary.txt, anything else = one text file with every
+# report one after the other and the summary at the end
+# nothing is kept per prompt apart from the running totals, so memory doesn't grow with the batch
+# (a zip still keeps its small central directory entry per file until it is closed)
+# the file stays open between prompts, close() (or leaving a with block) always releases it, even
+# when writing the summary fails, so a batch that breaks halfway still leaves a readable file
+# https://docs.python.org/3/library/zipfile.html#zipfile.ZipFile.open
+
+import io
+import threading
+import zipfile
+from collections import Counter
+
+WRITE_BUFFER_BYTES = 1024 * 1024
+TOP_TOKEN_COUNT = 10  # most frequent top tokens listed in the summary
+SUMMED_FIELDS = [  # run stats that are added up across the batch when a method reports them
+    ("api_calls", "API calls"),
+    ("calls_saved", "Duplicate requests skipped"),
+    ("embedding_requests", "Embedding requests"),
+    ("embedding_cache_hits", "Embedding cache hits"),
+]
+
+
+class BatchReportWriter:
+    def __init__(self, file_path, write_report, title):
+        # write_report(f, result_data) writes one prompt's report into an open text file
+        self.file_path = file_path
+        self.write_report = write_report
+        self.title = title
+        self._lock = threading.Lock()
+
+        self.completed = 0  # running aggregates for the summary
+        self.failed = []  # (prompt number, short error)
+        self.token_count = 0
+        self.top_importance_sum = 0.0
+        self.top_tokens = Counter()  # most important token of each prompt
+        self.sums = {}
+        self.closed = False
+
+        self.is_zip = file_path.lower().endswith(".zip")
+        if self.is_zip:
+            self._zip = zipfile.ZipFile(file_path, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self._file = open(file_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_BYTES)
+            try:
+                self._file.write(f"{title} - BATCH REPORT\n")
+                self._file.write("=" * 50 + "\n\n")
+            except Exception:
+                self._file.close()
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add(self, prompt_idx, result_data):
+        with self._lock:
+            if self.is_zip:
+                with self._zip.open(f"prompt_{prompt_idx:03d}.txt", "w") as raw:
+                    f = io.TextIOWrapper(raw, encoding="utf-8")
+                    self.write_report(f, result_data)
+                    f.flush()
+                    f.detach()  # the zip entry is closed by the with block
+            else:
+                self._file.write(f"\n{'#' * 50}\nPROMPT {prompt_idx}\n{'#' * 50}\n\n")
+                self.write_report(self._file, result_data)
+
+            tokens = result_data.get("tokens", [])
+            self.completed += 1
+            self.token_count += len(tokens)
+            if tokens:
+                top = max(tokens, key=lambda t: t.get("importance", 0))
+                self.top_importance_sum += top.get("importance", 0)
+                self.top_tokens[top.get("token", "").strip() or "[whitespace]"] += 1
+            for field, _ in SUMMED_FIELDS:
+                if field in result_data:
+                    self.sums[field] = self.sums.get(field, 0) + result_data[field]
+
+    def add_failure(self, prompt_idx, error_msg):
+        with self._lock:
+            self.failed.append((prompt_idx, error_msg[:100]))
+
+    def close(self):
+        # writes the summary and releases the file, calling it again does nothing
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                if self.is_zip:
+                    with self._zip.open("summary.txt", "w") as raw:
+                        f = io.TextIOWrapper(raw, encoding="utf-8")
+                        f.write(f"{self.title} - BATCH REPORT\n")
+                        f.write("=" * 50 + "\n")
+                        self._write_summary(f)
+                        f.flush()
+                        f.detach()
+                else:
+                    self._write_summary(self._file)
+            finally:
+                if self.is_zip:
+                    self._zip.close()
+                else:
+                    self._file.close()
+
+    def _write_summary(self, f):
+        f.write("\nBATCH SUMMARY:\n")
+        f.write("-" * 50 + "\n")
+        f.write(f"Prompts analysed: {self.completed}\n")
+        f.write(f"Prompts failed: {len(self.failed)}\n")
+        f.write(f"Tokens scored: {self.token_count}\n")
+        if self.completed:
+            f.write(
+                f"Mean tokens per prompt: {self.token_count / self.completed:.1f}\n"
+            )
+            f.write(
+                f"Mean top token importance: {self.top_importance_sum / self.completed:.4f}\n"
+            )
+        for field, label in SUMMED_FIELDS:
+            if field in self.sums:
+                f.write(f"{label}: {self.sums[field]}\n")
+
+        if self.top_tokens:
+            f.write("\nMOST FREQUENT TOP TOKENS:\n")
+            for token, count in self.top_tokens.most_common(TOP_TOKEN_COUNT):
+                f.write(f"{token[:20]:<20} {count}\n")
+
+        if self.failed:
+            f.write("\nFAILED PROMPTS:\n")
+            for prompt_idx, error_msg in self.failed:
+                f.write(f"Prompt {prompt_idx}: {error_msg}\n")
@@ -0,0 +1,193 @@
+# completion_cache.py
+# process-wide cache for chat completion outputs (SHAP coalitions, baseline and full prompt)
+# keys are sha256 digests of everything that changes the output, so they are stable across
+# runs and different prompts or models can't collide
+# memory is bounded by byte size with least recently used eviction, entries can also be
+# persisted to storage/ so repeat runs hit the cache instead of the api
+# https://docs.python.org/3/library/collections.html#collections.OrderedDict
+# https://docs.python.org/3/library/sqlite3.html
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # in memory
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024  # in storage/
+MISSING = object()  # get default for callers that cache None payloads
+
+
+def default_cache_path():
+    return os.path.join(os.getcwd(), "storage", "completion_cache.sqlite")
+
+
+def make_completion_key(model, system_prompt, max_tokens, temperature, text, **extra):
+    payload = json.dumps(
+        {
+            "model": model,
+            "system_prompt": system_prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "text": text,
+            **extra,  # anything else that changes the request, e.g. n or logprobs
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(
+        self,
+        max_bytes=DEFAULT_MAX_BYTES,
+        persist=False,
+        path=None,
+        max_disk_bytes=DEFAULT_MAX_DISK_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.persist = persist  # default for get/put, a run can pass its own setting per call
+        self.path = path or default_cache_path()
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # key -> (value, size in bytes), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()  # batch mode runs one analysis thread per prompt
+        self._conn = None
+        self._clock = 0
+        self._disk_bytes = 0
+
+    def _connection(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "last_used INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)"
+            )
+            self._conn.commit()
+
+            row = self._conn.execute(
+                "SELECT MAX(last_used), COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()
+            self._clock = row[0] or 0
+            self._disk_bytes = row[1]
+        return self._conn
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _remember(self, key, value, size):
+        if key in self._entries:
+            self._bytes -= self._entries[key][1]
+        self._entries[key] = (value, size)
+        self._entries.move_to_end(key)
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def _persisting(self, persist):
+        return self.persist if persist is None else persist
+
+    def get(self, key, default=None, persist=None):
+        # a stored None is returned as None, pass default=MISSING to tell it apart from a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if self._persisting(persist):
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT value, size FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE completions SET last_used = ? WHERE key = ?",
+                        (self._tick(), key),
+                    )
+                    conn.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value, persist=None):
+        encoded = json.dumps(value, ensure_ascii=False)
+        size = len(encoded.encode("utf-8"))
+
+        with self._lock:
+            self._remember(key, value, size)
+
+            if self._persisting(persist):
+                conn = self._connection()
+                replaced = conn.execute(
+                    "SELECT size FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if replaced is not None:
+                    self._disk_bytes -= replaced[0]
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO completions (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, encoded, size, self._tick()),
+                )
+                self._disk_bytes += size
+                self._prune_disk(conn)
+                conn.commit()
+
+    def _prune_disk(self, conn):
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+
+        to_delete = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM completions ORDER BY last_used ASC"
+        ):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            to_delete.append((key,))
+            self._disk_bytes -= size
+        conn.executemany("DELETE FROM completions WHERE key = ?", to_delete)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    # one cache per process, shared by every frame and analysis thread
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = CompletionCache(persist=True)
+        return _shared_cache
@@ -0,0 +1,126 @@
+# embedding_backends.py
+# pluggable embedding backends for the cosine method
+# OpenAIEmbeddingBackend -> batched, cached calls to the embeddings api
+# LocalNgramEmbeddingBackend -> hashed character n-gram tf-idf vectors in pure numpy, runs offline
+# the local one is deterministic and cheap enough to pre-screen whole datasets on cpu,
+# so only the interesting prompts need to go to the paid model
+# https://en.wikipedia.org/wiki/Feature_hashing
+# https://en.wikipedia.org/wiki/Tf%E2%80%93idf
+
+import numpy as np
+
+from utils.embeddings import embed_texts
+
+
+class EmbeddingBackend:
+    name = "base"
+    requires_api_key = False
+
+    @property
+    def model_name(self):
+        return self.name
+
+    def embed(self, texts, on_chunk=None):
+        # one vector per text, same order as texts
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    name = "openai"
+    requires_api_key = True
+
+    def __init__(
+        self,
+        api_key,
+        model="text-embedding-3-small",
+        dimensions=None,
+        cache=None,
+        stats=None,
+    ):
+        from openai import OpenAI
+
+        self.client = OpenAI(api_key=api_key)
+        self.model = model
+        self.dimensions = dimensions  # None = native width
+        self.cache = cache
+        self.stats = stats
+
+    @property
+    def model_name(self):
+        return self.model
+
+    def embed(self, texts, on_chunk=None):
+        return embed_texts(
+            self.client,
+            texts,
+            self.model,
+            dimensions=self.dimensions,
+            cache=self.cache,
+            stats=self.stats,
+            on_chunk=on_chunk,
+        )
+
+
+class LocalNgramEmbeddingBackend(EmbeddingBackend):
+    name = "local"
+    requires_api_key = False
+
+    _HASH_MULTIPLIER = np.uint64(1099511628211)  # fnv prime, spreads the rolling hash
+
+    def __init__(self, n_features=1536, ngram_range=(3, 5)):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.idf = np.ones(n_features, dtype=np.float32)  # plain tf until fit() is called
+
+    @property
+    def model_name(self):
+        low, high = self.ngram_range
+        return f"char-ngram-tfidf-{low}-{high}"
+
+    def _feature_counts(self, text):
+        data = np.frombuffer(f" {text.lower()} ".encode("utf-8"), dtype=np.uint8)
+        data = data.astype(np.uint64)
+        counts = np.zeros(self.n_features, dtype=np.float32)
+
+        with np.errstate(over="ignore"):  # the hash is meant to wrap around
+            for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+                if len(data) < n:
+                    break
+                hashes = np.full(len(data) - n + 1, n, dtype=np.uint64)  # seed by n
+                for offset in range(n):  # rolling hash over every window of n bytes
+                    hashes = hashes * self._HASH_MULTIPLIER + data[offset : len(data) - n + 1 + offset]
+                hashes ^= hashes >> np.uint64(29)
+                counts += np.bincount(
+                    (hashes % np.uint64(self.n_features)).astype(np.int64),
+                    minlength=self.n_features,
+                ).astype(np.float32)
+
+        return counts
+
+    def fit(self, corpus):
+        # document frequencies over a dataset, e.g. every prompt in CustomSet.txt
+        corpus = [text for text in corpus if text]
+        if not corpus:
+            return self
+
+        document_frequency = np.zeros(self.n_features, dtype=np.float32)
+        for text in corpus:
+            document_frequency += self._feature_counts(text) > 0
+
+        self.idf = (
+            np.log((1 + len(corpus)) / (1 + document_frequency)) + 1
+        ).astype(np.float32)  # smoothed idf, same formula as sklearn
+        return self
+
+    def embed(self, texts, on_chunk=None):
+        texts = list(texts)
+        vectors = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i] = np.log1p(self._feature_counts(text)) * self.idf  # sublinear tf
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.maximum(norms, 1e-12)
+
+        if on_chunk:
+            on_chunk(1, 1)
+        return list(vectors)
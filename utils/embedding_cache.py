@@ -0,0 +1,140 @@
+# embedding_cache.py
+# persistent embedding cache kept in storage/ so re-running a dataset costs no api calls
+# entries are keyed by (embedding model, dimensions, sha256 of the text) and evicted least recently used first
+# https://docs.python.org/3/library/sqlite3.html
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 100000  # ~600MB at 1536 float32 dimensions
+
+
+def default_cache_path():
+    return os.path.join(os.getcwd(), "storage", "embedding_cache.sqlite")
+
+
+class EmbeddingCache:
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # analysis threads share one connection
+
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, "
+            "dimensions INTEGER NOT NULL, "
+            "text_hash TEXT NOT NULL, "
+            "vector BLOB NOT NULL, "
+            "last_used INTEGER NOT NULL, "
+            "PRIMARY KEY (model, dimensions, text_hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+        # logical clock for lru order, timestamps can tie inside one batch
+        row = self._conn.execute("SELECT MAX(last_used) FROM embeddings").fetchone()
+        self._clock = row[0] or 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get_many(self, model, dimensions, texts):
+        # returns a float32 vector per text, or None where the text is not cached
+        dimensions = dimensions or 0  # 0 = the model's native width
+        results = []
+
+        with self._lock:
+            for text in texts:
+                key = (model, dimensions, self.text_hash(text))
+                row = self._conn.execute(
+                    "SELECT vector FROM embeddings WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                    key,
+                ).fetchone()
+
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+
+                self.hits += 1
+                self._conn.execute(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                    (self._tick(),) + key,
+                )
+                results.append(np.frombuffer(row[0], dtype=np.float32))
+
+            self._conn.commit()
+
+        return results
+
+    def put_many(self, model, dimensions, texts, vectors):
+        dimensions = dimensions or 0
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        model,
+                        dimensions,
+                        self.text_hash(text),
+                        np.asarray(vector, dtype=np.float32).tobytes(),
+                        self._tick(),
+                    )
+                    for text, vector in zip(texts, vectors)
+                ],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    # one cache per process, every embedding user should go through this
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = EmbeddingCache()
+        return _shared_cache
@@ -0,0 +1,115 @@
+# embeddings.py
+# batched embedding requests so a prompt costs a few round trips instead of one per token
+# https://platform.openai.com/docs/api-reference/embeddings/create
+# https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+
+import base64
+
+import numpy as np
+
+MAX_INPUTS_PER_REQUEST = 2048  # api limit on the length of the input list
+MAX_TOKENS_PER_REQUEST = 300000  # api limit summed across all inputs of one request
+MAX_TOKENS_PER_INPUT = 8191  # context length of the text-embedding-3 models
+
+
+def count_tokens(texts, enc=None):
+    if enc is None:
+        import tiktoken
+
+        enc = tiktoken.get_encoding("cl100k_base")  # tokenizer used by the embedding models
+    return [len(ids) for ids in enc.encode_ordinary_batch(texts)]
+
+
+def chunk_inputs(
+    token_counts,
+    max_inputs=MAX_INPUTS_PER_REQUEST,
+    max_tokens=MAX_TOKENS_PER_REQUEST,
+):
+    # split the input indices into requests that stay under both api limits
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    for i, count in enumerate(token_counts):
+        if count > MAX_TOKENS_PER_INPUT:
+            raise ValueError(
+                f"Input {i} has {count} tokens, the embedding model accepts at most {MAX_TOKENS_PER_INPUT}."
+            )
+
+        if current and (
+            len(current) >= max_inputs or current_tokens + count > max_tokens
+        ):
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+
+        current.append(i)
+        current_tokens += count
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def decode_embedding(data):
+    # base64 payload is little endian float32, decode it without building a python list
+    if isinstance(data, str):
+        return np.frombuffer(base64.b64decode(data), dtype="<f4")
+    return np.asarray(data, dtype=np.float32)  # float lists from older responses
+
+
+def embed_texts(
+    client,
+    texts,
+    model,
+    dimensions=None,
+    enc=None,
+    on_chunk=None,
+    cache=None,
+    stats=None,
+):
+    # returns one embedding per text in the same order as texts
+    # cached texts are served from the cache, only the rest are sent to the api
+    # dimensions=None keeps the model's native width
+    texts = list(texts)
+    if not texts:
+        return []
+
+    if cache is not None:
+        embeddings = cache.get_many(model, dimensions, texts)
+    else:
+        embeddings = [None] * len(texts)
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    missing_texts = [texts[i] for i in missing]
+    chunks = chunk_inputs(count_tokens(missing_texts, enc)) if missing else []
+
+    request_options = {"encoding_format": "base64"}
+    if dimensions:
+        request_options["dimensions"] = dimensions  # text-embedding-3 models only
+
+    for chunk_number, chunk in enumerate(chunks, 1):
+        response = client.embeddings.create(
+            input=[missing_texts[i] for i in chunk], model=model, **request_options
+        )
+        for item in response.data:  # item.index is the position inside this request
+            embeddings[missing[chunk[item.index]]] = decode_embedding(item.embedding)
+
+        if cache is not None:
+            cache.put_many(
+                model,
+                dimensions,
+                [missing_texts[i] for i in chunk],
+                [embeddings[missing[i]] for i in chunk],
+            )
+
+        if on_chunk:
+            on_chunk(chunk_number, len(chunks))
+
+    if stats is not None:
+        stats["cache_hits"] = stats.get("cache_hits", 0) + len(texts) - len(missing)
+        stats["api_inputs"] = stats.get("api_inputs", 0) + len(missing)
+        stats["api_requests"] = stats.get("api_requests", 0) + len(chunks)
+
+    return embeddings
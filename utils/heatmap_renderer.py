@@ -0,0 +1,98 @@
+# heatmap_renderer.py
+# renders heatmap pngs in worker processes so the tk thread never waits on matplotlib
+# the generators draw on their own Figure with the Agg canvas, the workers are spawned (not
+# forked from the tk process) and use the Agg backend, so nothing in them touches the display
+# finished renders are reported back with widget.after, same as the analysis threads do
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+# https://matplotlib.org/stable/users/explain/figure/backends.html
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+MAX_WORKERS = max(1, min(os.cpu_count() or 1, 8))
+HEATMAP_FIELDS = [  # all the generators read, the api key and stored responses stay in the app
+    "tokens",
+    "model",
+    "embedding_backend",
+    "embedding_model",
+    "dimensions",
+]
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")  # seaborn imports pyplot, keep it off the gui backends
+
+
+def _render(generator, result_data, output_path):
+    # runs in the worker, imports the generator module there
+    if generator == "shap":
+        from features.methods.shap_values.heatmap_generator import generate_shap_heatmap
+
+        return generate_shap_heatmap(result_data, output_path)
+
+    from features.methods.cosine_similarity.heatmap_generator import generate_token_heatmap
+
+    return generate_token_heatmap(result_data, output_path)
+
+
+class HeatmapRenderer:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None  # started on the first render
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def render(self, generator, result_data, output_path, widget, on_done):
+        # generator is "shap" or "cosine", on_done(success, error_msg) runs on the tk thread
+        data = {key: result_data[key] for key in HEATMAP_FIELDS if key in result_data}
+
+        def finished(future):
+            try:
+                success = future.result()
+                error_msg = None if success else "Failed to create heatmap."
+            except BrokenProcessPool as e:  # a worker died, the pool can't take new work
+                self.reset()
+                success, error_msg = False, str(e)
+            except Exception as e:
+                success, error_msg = False, str(e)
+            widget.after(0, lambda: on_done(success, error_msg))
+
+        try:
+            future = self._pool().submit(_render, generator, data, output_path)
+        except BrokenProcessPool:
+            self.reset()
+            future = self._pool().submit(_render, generator, data, output_path)
+        future.add_done_callback(finished)
+
+    def reset(self):
+        # the next render starts a fresh pool
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+_shared_renderer = None
+_shared_lock = threading.Lock()
+
+
+def get_heatmap_renderer():
+    global _shared_renderer
+    with _shared_lock:
+        if _shared_renderer is None:
+            _shared_renderer = HeatmapRenderer()
+        return _shared_renderer
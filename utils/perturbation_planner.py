@@ -0,0 +1,41 @@
+# perturbation_planner.py
+# removing either copy of a repeated token often decodes to the same prompt,
+# so identical perturbed texts are collapsed into one request and the result is fanned back out
+# used by the cosine perturbations and the SHAP coalition texts
+
+
+class PerturbationPlan:
+    def __init__(self):
+        self.texts = []  # unique texts in first seen order, this is what gets requested
+        self.keys = []  # every key added, in order
+        self._text_index = {}  # text -> index into self.texts
+        self._key_index = {}  # key -> index into self.texts
+
+    def add(self, key, text):
+        index = self._text_index.get(text)
+        if index is None:
+            index = len(self.texts)
+            self._text_index[text] = index
+            self.texts.append(text)
+
+        self.keys.append(key)
+        self._key_index[key] = index
+        return index
+
+    def index_of(self, key):
+        return self._key_index[key]
+
+    def result_for(self, key, results):
+        # results line up with self.texts
+        return results[self._key_index[key]]
+
+    def fan_out(self, results):
+        # one result per added key, in the order the keys were added
+        return [results[self._key_index[key]] for key in self.keys]
+
+    @property
+    def calls_saved(self):
+        return len(self.keys) - len(self.texts)
+
+    def __len__(self):
+        return len(self.texts)
@@ -0,0 +1,80 @@
+# request_pool.py
+# runs blocking api calls (chat completions) on a bounded pool of worker threads
+# results are handed back as they arrive so the caller can aggregate while slower requests
+# are still in flight, the number of calls stays the same, only the waiting overlaps
+# the limit is process-wide: batch mode runs one analysis per prompt at the same time, they all
+# take their slots from the same limiter, so N prompts still only have the setting in flight
+# https://docs.python.org/3/library/concurrent.futures.html
+# https://docs.python.org/3/library/threading.html#condition-objects
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 32  # keep well below the account rate limits
+
+
+class RequestLimiter:
+    # a semaphore whose size can change while calls are waiting on it
+    def __init__(self, limit=DEFAULT_CONCURRENCY):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = max(1, min(int(limit), MAX_CONCURRENCY))
+            self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+_shared_limiter = RequestLimiter()
+
+
+def set_concurrency(limit):
+    # the concurrent requests setting, for every run in the process
+    _shared_limiter.set_limit(limit)
+
+
+def _limited(fn):
+    def call(item):
+        with _shared_limiter:
+            return fn(item)
+
+    return call
+
+
+def run_concurrently(fn, items, max_workers=DEFAULT_CONCURRENCY):
+    # yields (index into items, fn(item)) in completion order
+    # the first error is raised and anything not started yet is cancelled
+    # every fn(item) holds a slot of the shared limiter while it runs
+    items = list(items)
+    if not items:
+        return
+
+    fn = _limited(fn)
+    max_workers = max(1, min(int(max_workers), len(items)))
+    if max_workers == 1:  # no point spinning up threads
+        for i, item in enumerate(items):
+            yield i, fn(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, item): i for i, item in enumerate(items)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,151 @@
+# results_exporter.py
+# every finished analysis is appended to storage/results/ in a form that can be loaded back
+# without parsing the text reports:
+#   runs.jsonl      one json line per analysed prompt (method, prompt, model, run stats ...)
+#   tokens-*.npz    the per token columns of a batch of runs as typed arrays
+#                   (run, position, token_id, importance, ci_width), run indexes run_ids
+# results are buffered and written a batch at a time (and at exit), not one file per prompt
+# the api key is never written, nor the modified prompts and model responses of the cosine
+# method (one per token, they belong in the text report, not in every line of runs.jsonl)
+# https://numpy.org/doc/stable/reference/generated/numpy.savez_compressed.html
+# https://jsonlines.org/
+
+import atexit
+import glob
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+DEFAULT_FLUSH_EVERY = 16  # runs per npz part
+EXCLUDED_FIELDS = {  # secret, stored as columns, or grows with the prompt length squared
+    "api_key",
+    "tokens",
+    "token_ids",
+    "perturbations",
+    "original_response",
+}
+
+
+def default_results_folder():
+    return os.path.join(os.getcwd(), "storage", "results")
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):  # estimator stats can hold numpy scalars
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class ResultsExporter:
+    def __init__(self, folder=None, flush_every=DEFAULT_FLUSH_EVERY):
+        self.folder = folder or default_results_folder()
+        self.flush_every = flush_every
+        self._pending = []  # (run record, token columns)
+        self._lock = threading.Lock()  # analysis threads finish at the same time in batch mode
+
+    def add(self, method, result_data):
+        token_ids = result_data.get("token_ids", [])
+        tokens = sorted(result_data.get("tokens", []), key=lambda t: t.get("position", 0))
+        positions = np.array([t.get("position", 0) for t in tokens], dtype=np.int32)
+        columns = {
+            "position": positions,
+            "token_id": np.array(
+                [token_ids[p] if p < len(token_ids) else -1 for p in positions],
+                dtype=np.int32,
+            ),
+            "importance": np.array([t.get("importance", 0.0) for t in tokens], dtype=np.float32),
+            "ci_width": np.array(  # nan where the estimator gives no interval
+                [t.get("ci_width", np.nan) for t in tokens], dtype=np.float32
+            ),
+        }
+
+        record = {
+            "run_id": uuid.uuid4().hex,
+            "method": method,
+            "token_count": len(tokens),
+            **{k: v for k, v in result_data.items() if k not in EXCLUDED_FIELDS},
+        }
+
+        with self._lock:
+            self._pending.append((record, columns))
+            if len(self._pending) >= self.flush_every:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        os.makedirs(self.folder, exist_ok=True)
+
+        part = f"tokens-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.npz"
+        run_ids = np.array([record["run_id"] for record, _ in pending])
+        np.savez_compressed(
+            os.path.join(self.folder, part),
+            run_ids=run_ids,
+            run=np.concatenate(
+                [
+                    np.full(len(columns["position"]), n, dtype=np.int32)
+                    for n, (_, columns) in enumerate(pending)
+                ]
+            ),
+            **{
+                name: np.concatenate([columns[name] for _, columns in pending])
+                for name in ("position", "token_id", "importance", "ci_width")
+            },
+        )
+
+        # the part is written first, so every line in runs.jsonl points at a file that exists
+        lines = [
+            json.dumps({**record, "part": part}, default=_json_default, ensure_ascii=False)
+            for record, _ in pending
+        ]
+        with open(os.path.join(self.folder, "runs.jsonl"), "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def load_results(folder=None):
+    # (list of run records, dict of token columns), the run column indexes the run records
+    folder = folder or default_results_folder()
+    runs = []
+    runs_path = os.path.join(folder, "runs.jsonl")
+    if os.path.exists(runs_path):
+        with open(runs_path, encoding="utf-8") as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    run_index = {record["run_id"]: n for n, record in enumerate(runs)}
+
+    parts = []
+    for path in sorted(glob.glob(os.path.join(folder, "tokens-*.npz"))):
+        with np.load(path) as part:
+            columns = {name: part[name] for name in part.files}
+        # part local run numbers -> positions in runs
+        lookup = np.array([run_index.get(run_id, -1) for run_id in columns.pop("run_ids")])
+        columns["run"] = lookup[columns["run"]]
+        parts.append(columns)
+
+    names = ("run", "position", "token_id", "importance", "ci_width")
+    if not parts:
+        return runs, {name: np.zeros(0) for name in names}
+    return runs, {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+
+_shared_exporter = None
+_shared_lock = threading.Lock()
+
+
+def get_results_exporter():
+    global _shared_exporter
+    with _shared_lock:
+        if _shared_exporter is None:
+            _shared_exporter = ResultsExporter()
+            atexit.register(_shared_exporter.flush)  # whatever is still buffered when the app closes
+        return _shared_exporter
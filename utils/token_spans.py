@@ -0,0 +1,68 @@
+# token_spans.py
+# groups tiktoken tokens into sentences, clauses and words
+# a span is a (start, end) range of token positions, end exclusive
+
+SENTENCE_ENDINGS = (".", "!", "?")
+CLAUSE_ENDINGS = SENTENCE_ENDINGS + (",", ";", ":")
+
+
+def _split_after(tokens, start, end, endings):
+    spans = []
+    span_start = start
+    for i in range(start, end):
+        text = tokens[i]
+        if "\n" in text or text.rstrip().endswith(endings):
+            spans.append((span_start, i + 1))
+            span_start = i + 1
+    if span_start < end:
+        spans.append((span_start, end))
+    return spans
+
+
+def sentence_spans(tokens, start=0, end=None):
+    end = len(tokens) if end is None else end
+    return _split_after(tokens, start, end, SENTENCE_ENDINGS)
+
+
+def clause_spans(tokens, start=0, end=None):
+    end = len(tokens) if end is None else end
+    return _split_after(tokens, start, end, CLAUSE_ENDINGS)
+
+
+def word_spans(tokens, start=0, end=None):
+    # sub-word pieces are glued to the previous token, a word starts at whitespace or punctuation
+    end = len(tokens) if end is None else end
+    spans = []
+    span_start = start
+    for i in range(start + 1, end):
+        text = tokens[i]
+        previous = tokens[i - 1]
+        if (
+            text[:1].isspace()
+            or not text[:1].isalnum()
+            or not previous[-1:].isalnum()
+        ):
+            spans.append((span_start, i))
+            span_start = i
+    if span_start < end:
+        spans.append((span_start, end))
+    return spans
+
+
+def single_token_spans(tokens, start=0, end=None):
+    end = len(tokens) if end is None else end
+    return [(i, i + 1) for i in range(start, end)]
+
+
+# coarse to fine, each level splits the spans of the level above
+SPAN_LEVELS = [sentence_spans, word_spans, single_token_spans]
+
+
+def child_spans(tokens, span, level, levels=SPAN_LEVELS):
+    # split span at the given level, skipping levels that would leave it in one piece
+    while level < len(levels):
+        children = levels[level](tokens, span[0], span[1])
+        if len(children) > 1:
+            return children, level
+        level += 1
+    return [], level